@@ -0,0 +1,551 @@
+"""Timing benchmarks for the detector and stage communication code.
+
+Run from the blcontrol directory:
+    python benchmarks.py
+
+Device benchmarks run against the emulators in `detector.emulator` and
+`stages.emulator`, so no hardware is needed.
+"""
+
+import ConfigParser
+import numpy as np
+import os
+import Queue
+import tempfile
+import threading
+import time
+import timeit
+from detector import dp5io, pids
+from detector.emulator import DP5Emulator, encode_packet
+from detector.exceptions import TimeoutError
+from stages.emulator import ZaberEmulator
+import stages.commands as com
+from stages.stageio import StageIO, TopologyCache, ZeroPosConfig
+from scan_threads import (StepScan, LinearScanThread, AdaptiveLinearScanThread,
+                          GridScanThread, AdaptiveGridScanThread)
+import scan_plans
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'config', 'blconf.txt')
+
+
+def _legacy_decode(specdata):
+    """Per-channel spectrum decode used before `dp5io.decode_spectrum`."""
+    return [dp5io.byte2int(specdata[i:i+3])
+            for i in range(0, len(specdata), 3)]
+
+
+def bench_spectrum_decode(repeat=20):
+    """Compares the legacy and NumPy spectrum decoders for every channel count.
+
+    Args:
+        repeat (int): Number of decodes to time for each method.
+
+    Returns (list of tuples): (numchans, legacy_ms, numpy_ms) for each
+        channel count in `pids.SPEC_CHAN`.
+    """
+    results = []
+    for numchans in sorted(pids.SPEC_CHAN.values()):
+        counts = np.random.randint(0, 1<<24, numchans)
+        specdata = ''.join(chr(c & 0xFF) + chr((c >> 8) & 0xFF) + chr(c >> 16)
+                           for c in counts)
+        data = specdata + 64*chr(0)   # trailing status block
+        assert _legacy_decode(specdata) == counts.tolist()
+        assert (dp5io.decode_spectrum(data, numchans) == counts).all()
+        legacy = timeit.timeit(lambda: _legacy_decode(specdata),
+                               number=repeat)
+        vectorized = timeit.timeit(
+            lambda: dp5io.decode_spectrum(data, numchans, np.uint32),
+            number=repeat)
+        results.append((numchans, 1000*legacy/repeat, 1000*vectorized/repeat))
+    return results
+
+
+class _LoopbackPort(object):
+    """Stand-in for serial.Serial that replays a fixed byte string."""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data) - self.pos
+
+    def read(self, size=1):
+        chunk = self.data[self.pos:self.pos+size]
+        self.pos += len(chunk)
+        return chunk
+
+    def readinto(self, buf):
+        chunk = self.read(len(buf))
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def _legacy_read(port):
+    """Packet read used before `dp5io.PacketReader`."""
+    first = port.read(2)
+    if first != pids.SYNC:
+        raise TimeoutError('Read timed out. Check detector connection.')
+    header = first + port.read(4)
+    datalen = dp5io.byte2int(header[4:6], little_endian=False)
+    data = port.read(datalen)
+    checksum = port.read(2)
+    reply = dp5io.DP5Reply(header, data, checksum)
+    if not reply.is_checksum_good():
+        raise ValueError('Bad checksum in reply')
+    return reply
+
+
+def bench_packet_read(numpackets=50):
+    """Compares the legacy and buffered readers on 8192-channel spectra.
+
+    Returns (tuple): (legacy_ms, buffered_ms) per packet.
+    """
+    pid = [p for p, n in pids.SPEC_CHAN.items() if n == 8192][0]
+    data = ''.join(chr(i % 256) for i in range(3*8192 + dp5io.STATUS_LEN))
+    stream = numpackets*encode_packet(pid, data)
+
+    def legacy():
+        port = _LoopbackPort(stream)
+        for _ in range(numpackets):
+            _legacy_read(port)
+
+    def buffered():
+        reader = dp5io.PacketReader(_LoopbackPort(stream))
+        for _ in range(numpackets):
+            reader.read()
+
+    legacy_time = min(timeit.repeat(legacy, number=1, repeat=5))
+    buffered_time = min(timeit.repeat(buffered, number=1, repeat=5))
+    return 1000*legacy_time/numpackets, 1000*buffered_time/numpackets
+
+
+def bench_acq_start(det, acqtime=1.0, num_chans=256, points=10):
+    """Times starting an acquisition the legacy way and with `begin_acq`.
+
+    The legacy sequence is the MCAC write made by ScanController followed by
+    CLRSPEC, a PRET write and ENMCA.  The MCA is disabled after each start.
+
+    Args:
+        det (DP5Device): Detector to use.
+
+    Returns (tuple): (legacy_ms, fused_ms) per point.
+    """
+    legacy = fused = 0.
+    for _ in range(points):
+        start = time.time()
+        det.set_setting('MCAC', num_chans)
+        det.clear_spectrum()
+        det.set_setting('PRET', acqtime)
+        det.enable_mca()
+        legacy += time.time() - start
+        det.disable_mca()
+    for _ in range(points):
+        start = time.time()
+        det.begin_acq(acqtime, num_chans)
+        fused += time.time() - start
+        det.disable_mca()
+    return 1000*legacy/points, 1000*fused/points
+
+
+def bench_readout(det, repeat=3):
+    """Times GETSTAT and spectrum + status reads for every channel count.
+
+    Args:
+        det (DP5Device): Detector to use.
+
+    Returns (tuple): (status_ms, list of (numchans, spectrum_ms)).
+    """
+    start = time.time()
+    for _ in range(repeat):
+        det.get_status()
+    status_ms = 1000*(time.time() - start)/repeat
+    results = []
+    for numchans in sorted(pids.SPEC_CHAN.values()):
+        det.set_setting('MCAC', numchans)
+        start = time.time()
+        for _ in range(repeat):
+            det.get_spectrum()
+        results.append((numchans, 1000*(time.time() - start)/repeat))
+    return status_ms, results
+
+
+def bench_emulated_device(points=5):
+    """Runs the device benchmarks against an emulated DP5.
+
+    Returns (dict): Results of `bench_acq_start` and `bench_readout`, and the
+        times to read all settings with an empty and a full settings shadow.
+    """
+    emu = DP5Emulator()
+    emu.start()
+    det = dp5io.DP5Device(emu.config())
+    try:
+        results = {'acq start': bench_acq_start(det, points=points)}
+        det.resync_settings()
+        det._clear_shadow()
+        start = time.time()
+        det.get_all_settings()
+        cold = time.time() - start
+        start = time.time()
+        det.get_all_settings()
+        results['all settings'] = (1000*cold, 1000*(time.time() - start))
+        results['readout'] = bench_readout(det)
+    finally:
+        det.disconnect()
+        emu.stop()
+    return results
+
+
+def bench_stage_steps(motor, step=0.1, points=10):
+    """Times a series of small moves, waited for one at a time.
+
+    Args:
+        motor (Motor): Motor to move, starting from its current position.
+        step (float): Step size in mm or degrees.
+
+    Returns (float): Mean time per step in ms.
+    """
+    start_pos = motor.pos
+    start = time.time()
+    for i in range(1, points + 1):
+        motor.start_move(start_pos + i*step).join()
+    return 1000*(time.time() - start)/points
+
+
+def bench_emulated_stages(motor_name='dx', repeat=10):
+    """Runs the stage benchmarks against an emulated daisy chain.
+
+    Zero positions and the topology cache are kept in temporary files.
+
+    Returns (dict): Times in ms to initialize StageIO without and with a
+        topology cache ('init' and 'cached init'), to query a position and
+        to read the cached position, the mean reply latency of position
+        queries and the time per step of `bench_stage_steps`.
+    """
+    config = ConfigParser.SafeConfigParser()
+    config.read(CONFIG_PATH)
+    emu = ZaberEmulator(config)
+    emu.start()
+    fd, zeropath = tempfile.mkstemp()
+    os.close(fd)
+    topologypath = tempfile.mktemp()
+    try:
+        start = time.time()
+        sio = StageIO(emu.config(), ZeroPosConfig(zeropath),
+                      TopologyCache(topologypath))
+        results = {'init': 1000*(time.time() - start)}
+        sio.close()
+        start = time.time()
+        sio = StageIO(emu.config(), ZeroPosConfig(zeropath),
+                      TopologyCache(topologypath))
+        results['cached init'] = 1000*(time.time() - start)
+        motor = sio.motors[motor_name]
+        start = time.time()
+        for _ in range(repeat):
+            motor.query(com.POS)
+        results['position'] = 1000*(time.time() - start)/repeat
+        start = time.time()
+        for _ in range(repeat):
+            motor.pos
+        results['cached position'] = 1000*(time.time() - start)/repeat
+        results['position latency'] = \
+            1000*motor.reply_stats[com.POS]['mean latency']
+        results['step'] = bench_stage_steps(motor)
+        sio.close()
+    finally:
+        emu.stop()
+        os.remove(zeropath)
+        if os.path.exists(topologypath):
+            os.remove(topologypath)
+    return results
+
+
+def bench_step_scan(det, motor, step=0.05, points=10, acctime=0.2):
+    """Times the overhead per point of step scans without and with
+    pipelining.
+
+    Args:
+        det (DP5Device): Detector to acquire spectra with.
+        motor (Motor): Motor to scan, starting from its current position.
+
+    Returns (tuple): Mean overhead per point in ms beyond `acctime`,
+        sequential and pipelined.
+    """
+    return tuple(1000*_step_scan_overhead(det, motor, step, points, acctime,
+                                          pipelined)
+                 for pipelined in (False, True))
+
+
+def bench_profiles(det, motor, step=0.05, points=10, acctime=0.2):
+    """Times pipelined step scans with each motion profile of `motor`.
+
+    Returns (list): Tuples of profile name and mean time per point in ms,
+        starting with the settings stored in the controller ('stored').
+    """
+    results = []
+    for name in [None] + sorted(motor.profiles):
+        previous = motor.use_profile(name)
+        overhead = _step_scan_overhead(det, motor, step, points, acctime)
+        results.append((name or 'stored', 1000*(overhead + acctime)))
+        motor.apply_settings(previous)
+    return results
+
+
+def _step_scan_overhead(det, motor, step, points, acctime, pipelined=True):
+    """Runs a step scan from the motor's current position and returns the
+    mean overhead per point in seconds."""
+    start_pos = motor.pos
+    locs = [start_pos + i*step for i in range(1, points + 1)]
+    scan = StepScan(det, acctime, Queue.Queue(), 256, pipelined)
+    start_move = lambda loc, phase: motor.start_move(loc)
+    for _ in scan.run(locs, start_move, threading.Event()):
+        pass
+    return np.mean(scan.overheads)
+
+
+def bench_plan_order(speeds=(0.6, 0.6), gridsize=20, num_points=300):
+    """Estimates stage travel time along scan paths in each order.
+
+    Returns (dict): Maps plan names to tuples of the travel time in seconds
+        in the initial order and in the optimized order: serpentine for a
+        square grid, nearest-neighbour for a random point set.
+    """
+    locs = np.linspace(0, 1, gridsize)
+    plan = scan_plans.grid(['dx', 'dy'], [locs, locs])
+    results = {'grid': (plan.travel_time(speeds),
+                        plan.reordered(scan_plans.serpentine).travel_time(
+                            speeds))}
+    points = np.random.RandomState(0).rand(num_points, 2)
+    plan = scan_plans.point_set(['dx', 'dy'], points)
+    results['points'] = (plan.travel_time(speeds),
+                         plan.reordered(scan_plans.nearest_neighbour,
+                                        speeds).travel_time(speeds))
+    return results
+
+
+class EmulatedBeam(threading.Thread):
+    """Sets the count rate of an emulated DP5 as if the emulated stages moved
+    the detector through a Gaussian beam.
+
+    Attributes:
+        center (dict): Maps motor names to the beam center in real units.
+            Motors not named do not affect the count rate.
+        width (float): Standard deviation of the beam profile in real units.
+    """
+    def __init__(self, stage_emu, det_emu, motors, center, width,
+                 peak_rate=20000., background=200.):
+        super(EmulatedBeam, self).__init__()
+        self.stage_emu = stage_emu
+        self.det_emu = det_emu
+        self.motors = motors
+        self.center = center
+        self.width = width
+        self.peak_rate = peak_rate
+        self.background = background
+        self._stopper = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        axes = {axis.number: axis for axis in self.stage_emu.axes}
+        while not self._stopper.wait(0.005):
+            r2 = 0.
+            for name, center in self.center.items():
+                motor = self.motors[name]
+                pos = motor.stepdata2pos(axes[motor.number].pos)
+                r2 += ((pos - center)/self.width)**2
+            self.det_emu.count_rate = (self.background +
+                                       self.peak_rate*np.exp(-0.5*r2))
+
+    def stop(self):
+        self._stopper.set()
+        self.join()
+
+
+def _run_scan_thread(thread):
+    """Runs a scan thread to completion, consuming its queues, and returns
+    the wall time in seconds."""
+    for queue in (thread.plotqueue, thread.specqueue):
+        drain = threading.Thread(target=_drain, args=(queue,))
+        drain.daemon = True
+        drain.start()
+    started = time.time()
+    thread.start()
+    thread.join()
+    return time.time() - started
+
+
+def _drain(queue):
+    while True:
+        queue.get()
+        queue.task_done()
+
+
+def bench_adaptive_linear(det, motor, beam, step=0.01, points=81,
+                          acctime=0.1):
+    """Compares dense and adaptive linear scans across an emulated beam.
+
+    Both scans may measure the same locations; the adaptive scan measures
+    only some of them, so its estimates of the peak are less precise.  The
+    errors of both are returned to show by how much.
+
+    Args:
+        det (DP5Device): Detector to acquire spectra with.
+        motor (Motor): Motor to scan, starting from its current position.
+        beam (EmulatedBeam): Beam to center in the scan range.
+
+    Returns (dict): Maps 'dense' and 'adaptive' to tuples of the number of
+        points, the time in seconds, and the errors of the centre and FWHM
+        from `cen_fwhm` in real units.
+    """
+    start_pos = motor.pos
+    locs = [start_pos + i*step for i in range(points)]
+    center = start_pos + 0.46*(points - 1)*step
+    beam.center = {motor.name: center}
+    fwhm = 2*np.sqrt(2*np.log(2))*beam.width
+    results = {}
+    for name, cls in (('dense', LinearScanThread),
+                      ('adaptive', AdaptiveLinearScanThread)):
+        thread = cls(det, motor, acctime, locs, num_chans=256)
+        elapsed = _run_scan_thread(thread)
+        cen, fw = thread.data.cen_fwhm()
+        results[name] = (len(thread.data.spectra), elapsed, cen - center,
+                         fw - fwhm)
+    return results
+
+
+def bench_adaptive_grid(det, sio, beam, step=0.02, gridsize=16,
+                        acctime=0.05):
+    """Compares full and adaptive grid scans of motors dx and dy over an
+    emulated beam.
+
+    Both scans may measure the same grid points; the adaptive scan measures
+    only some of them.  The errors of both centroids are returned to show
+    what that costs in precision.
+
+    Args:
+        det (DP5Device): Detector to acquire spectra with.
+        sio (StageIO): Stages, scanned from their current positions.
+        beam (EmulatedBeam): Beam to place in the scan field.
+
+    Returns (dict): Maps 'full' and 'adaptive' to tuples of the number of
+        exposures, the time in seconds, and the errors of the centroid
+        `GridScan.cen` in dx and dy in real units.
+    """
+    x0, y0 = sio.motors['dx'].pos, sio.motors['dy'].pos
+    xlocs = [x0 + i*step for i in range(gridsize)]
+    ylocs = [y0 + i*step for i in range(gridsize)]
+    center = (x0 + 0.41*(gridsize - 1)*step, y0 + 0.53*(gridsize - 1)*step)
+    beam.center = {'dx': center[0], 'dy': center[1]}
+    results = {}
+    for name, cls in (('full', GridScanThread),
+                      ('adaptive', AdaptiveGridScanThread)):
+        thread = cls(det, sio, xlocs, ylocs, acctime, num_chans=256)
+        elapsed = _run_scan_thread(thread)
+        if isinstance(thread.data.spectra, dict):
+            exposures = len(thread.data.spectra)
+        else:
+            exposures = thread.data.spectra.size
+        cen = thread.data.cen
+        results[name] = (exposures, elapsed, cen[0] - center[0],
+                         cen[1] - center[1])
+    return results
+
+
+def bench_emulated_scan(motor_name='dx'):
+    """Runs `bench_step_scan`, `bench_profiles` and the adaptive scan
+    benchmarks against an emulated DP5 and daisy chain.
+
+    Returns (dict): Results by benchmark name.
+    """
+    config = ConfigParser.SafeConfigParser()
+    config.read(CONFIG_PATH)
+    stage_emu = ZaberEmulator(config)
+    stage_emu.start()
+    det_emu = DP5Emulator()
+    det_emu.start()
+    fd, zeropath = tempfile.mkstemp()
+    os.close(fd)
+    topologypath = tempfile.mktemp()
+    try:
+        det = dp5io.DP5Device(det_emu.config())
+        sio = StageIO(stage_emu.config(), ZeroPosConfig(zeropath),
+                      TopologyCache(topologypath))
+        motor = sio.motors[motor_name]
+        results = {'step scan': bench_step_scan(det, motor),
+                   'profiles': bench_profiles(det, motor)}
+        beam = EmulatedBeam(stage_emu, det_emu, sio.motors, {}, 0.05)
+        beam.start()
+        try:
+            results['adaptive linear'] = bench_adaptive_linear(det, motor,
+                                                               beam)
+            beam.width = 0.03
+            results['adaptive grid'] = bench_adaptive_grid(det, sio, beam)
+        finally:
+            beam.stop()
+        sio.close()
+        det.disconnect()
+    finally:
+        stage_emu.stop()
+        det_emu.stop()
+        os.remove(zeropath)
+        if os.path.exists(topologypath):
+            os.remove(topologypath)
+    return results
+
+
+def main():
+    print('Spectrum decode (ms per spectrum)')
+    print('{0:>8} {1:>10} {2:>10} {3:>8}'.format('chans', 'legacy', 'numpy',
+                                                 'speedup'))
+    for numchans, legacy, vectorized in bench_spectrum_decode():
+        print('{0:>8} {1:>10.3f} {2:>10.3f} {3:>7.0f}x'.format(
+            numchans, legacy, vectorized, legacy/vectorized))
+    legacy, buffered = bench_packet_read()
+    print('\n8192-channel packet read (ms per packet)')
+    print('legacy: {0:.3f}  buffered: {1:.3f}'.format(legacy, buffered))
+    results = bench_emulated_device()
+    print('\nEmulated DP5 at 115200 baud (ms)')
+    print('acquisition start  legacy: {0:.1f}  fused: {1:.1f}'.format(
+        *results['acq start']))
+    print('all settings       cold: {0:.1f}  shadowed: {1:.1f}'.format(
+        *results['all settings']))
+    status_ms, readout = results['readout']
+    print('status read: {0:.1f}'.format(status_ms))
+    for numchans, spectrum_ms in readout:
+        print('{0:>8} channel spectrum: {1:.1f}'.format(numchans, spectrum_ms))
+    results = bench_emulated_stages()
+    print('\nEmulated Zaber stages at 9600 baud (ms)')
+    print('StageIO init  cold: {0:.0f}  cached: {1:.0f}'.format(
+        results['init'], results['cached init']))
+    print('position query: {0:.1f}  (reply latency {1:.1f})  '
+          'cached: {2:.3f}'.format(results['position'],
+                                   results['position latency'],
+                                   results['cached position']))
+    print('0.1 mm step: {0:.1f}'.format(results['step']))
+    results = bench_emulated_scan()
+    print('\nStep scan overhead per point, 0.05 mm steps (ms)')
+    print('sequential: {0:.1f}  pipelined: {1:.1f}'.format(
+        *results['step scan']))
+    print('Time per point by motion profile, 0.2 s/pt (ms)')
+    for name, point_ms in results['profiles']:
+        print('{0:>10}: {1:.1f}'.format(name, point_ms))
+    print('Linear scan across a 0.12 mm FWHM beam, 81 x 0.01 mm')
+    for name in ('dense', 'adaptive'):
+        print('{0:>10}: {1} points  {2:.1f} s  centre error {3:+.4f}  '
+              'FWHM error {4:+.4f}'.format(name,
+                                           *results['adaptive linear'][name]))
+    print('Grid scan of a 0.07 mm FWHM beam, 16 x 16 x 0.02 mm')
+    for name in ('full', 'adaptive'):
+        print('{0:>10}: {1} exposures  {2:.1f} s  centroid error '
+              '({3:+.4f}, {4:+.4f})'.format(name,
+                                            *results['adaptive grid'][name]))
+    results = bench_plan_order()
+    print('\nEstimated travel time of scan paths (s)')
+    print('20x20 grid  raster: {0:.1f}  serpentine: {1:.1f}'.format(
+        *results['grid']))
+    print('300 random points  given: {0:.1f}  nearest-neighbour: {1:.1f}'
+          .format(*results['points']))
+
+if __name__ == '__main__':
+    main()
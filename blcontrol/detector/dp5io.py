@@ -4,6 +4,7 @@ For a full description of the software capabilities of the DP5, see the
 DP5 Programmer's Guide.
 """
 
+import numpy as np
 import Queue
 import serial
 import struct
@@ -13,6 +14,15 @@ from detector import pids
 from detector.exceptions import (DeviceError, TimeoutError,
                                  UnexpectedReplyError)
 
+STATUS_LEN = 64    # length of the status block in bytes
+MAX_PACKET_LEN = 8 + 3*max(pids.SPEC_CHAN.values()) + STATUS_LEN
+
+## Request priority classes, most urgent first
+PRIORITY_CONTROL = 0        # acquisition control and user commands
+PRIORITY_READOUT = 1        # spectrum readout
+PRIORITY_HOUSEKEEPING = 2   # status polling
+PRIORITIES = (PRIORITY_CONTROL, PRIORITY_READOUT, PRIORITY_HOUSEKEEPING)
+
 class DP5Device(object):
     """A class representing a DP5 device.
 
@@ -25,6 +35,12 @@ class DP5Device(object):
             converting from channel to energy.
         gain (float): Amplifier gain setting.
         num_chans (int): Number of MCA channels in use.
+
+    ASCII settings read from or written to the device are kept in a shadow
+    so that `gain`, `num_chans`, `calibration` and the energy axis can be
+    computed without serial I/O.  Writes update the shadow for settings the
+    device stores verbatim and invalidate it for all others; `resync_settings`
+    reloads it from the device.
     """
     def __init__(self, config):
         self.config = config
@@ -32,6 +48,7 @@ class DP5Device(object):
         to = self.config.getint("Detector Port", "timeout")
         br = self.config.getint("Detector Port", "baudrate")
         self._port = serial.Serial(port=serialport, timeout=to, baudrate=br)
+        self._reader = PacketReader(self._port)
         #self._port.flushInput()
 
         # The following 2 lines will raise TimeoutError if det is not
@@ -39,7 +56,11 @@ class DP5Device(object):
         self._write(pids.ECHO_REQ, "Detector Ready")
         self._read()
         
-        self._lock = threading.Lock()  #read/write lock for serial port access
+        self._scheduler = RequestScheduler()  # serializes serial port access
+        self._shadow = {}   # setting name -> value string
+        self._sernum = None
+        self.last_io = time.time()   # time of the last exchange on the port
+        self.last_status = (0., None)   # (time received, parsed status)
         self.status_queue = Queue.Queue()
         self.status_thread = StatusThread(self)
         self.status_thread.start()
@@ -51,6 +72,8 @@ class DP5Device(object):
     def reconnect(self):
         if not self.is_connected:
             self._port.open()
+            self._reader.reset()
+            self._clear_shadow()
             self.status_thread = StatusThread(self)
             self.status_thread.start()
 
@@ -61,7 +84,7 @@ class DP5Device(object):
                 self.status_thread.join()
             self._port.close()
 
-    def send(self, *args):
+    def send(self, *args, **kwargs):
         """Sends a command and checks the reply for errors.
 
         Note: Blocks until a reply is received or port times out.  The DP5
@@ -71,12 +94,49 @@ class DP5Device(object):
         Args: a DP5Command or pid and data representing the command to be sent
             to the DP5.
 
+        Keyword Args:
+            parser (callable): Optional function called with the reply while
+                the port is still held.  The reply's data field is then a
+                memoryview into the receive buffer instead of a copy, and the
+                parser's return value is returned in place of the reply.
+            priority (int): Priority class of the request, one of
+                PRIORITY_CONTROL (default), PRIORITY_READOUT or
+                PRIORITY_HOUSEKEEPING.
+            merge_key: If given, a request waiting for the port with the same
+                key is not sent twice; all callers receive the result of one
+                exchange.  Only use for read-only requests.
+            on_error (callable): Optional function called while the port is
+                still held if the exchange or the parser raises an exception.
+
         Returns (DP5Reply): Reply received from the device.
         """
-        with self._lock:
-            self._write(*args)
-            reply = self._read()
-        return reply
+        parser = kwargs.pop('parser', None)
+        priority = kwargs.pop('priority', PRIORITY_CONTROL)
+        merge_key = kwargs.pop('merge_key', None)
+        on_error = kwargs.pop('on_error', None)
+        def exchange():
+            try:
+                try:
+                    self._write(*args)
+                    reply = self._read()
+                finally:
+                    self.last_io = time.time()
+                if parser is not None:
+                    return parser(reply)
+                return reply.detach()
+            except Exception:
+                if on_error is not None:
+                    on_error()
+                raise
+        return self._scheduler.run(exchange, priority, merge_key)
+
+    @property
+    def request_stats(self):
+        """Returns queue depth and wait time statistics of the port.
+
+        See `RequestScheduler.get_stats`.
+        """
+        return self._scheduler.get_stats()
 
     def _write(self, *args):
         #self._port.flush()
@@ -101,27 +161,17 @@ class DP5Device(object):
             TimeoutError: Read timed out or synced incorrectly.
             ValueError: Device reply has bad checksum.
             
-        Returns: A DP5Reply object encoding the packet received.
+        Returns: A DP5Reply object encoding the packet received.  Its data
+            field refers to the receive buffer and is only valid until the
+            next read.
         """
-        first = self._port.read(2)
-        if first != pids.SYNC:
-            raise TimeoutError('Read timed out. Check detector connection.')
-        header = first + self._port.read(4)
-        datalen = byte2int(header[4:6], little_endian=False)
-        data = self._port.read(datalen)
-        checksum = self._port.read(2)
-        if len(header) + len(data) + len(checksum) != datalen + 8:
-            raise TimeoutError('Read timed out.  Check detector connection.')
-        reply = DP5Reply(header, data, checksum)
+        reply = self._reader.read()
         if reply.pid[0] == pids.ACK and reply.pid != pids.ACK_OK:
             errorstr = pids.ERRORS[reply.pid]
             errmsg = 'DP5 Device returned error: {0}: "{1}"'.format(errorstr,
-                                                                  reply.data)
+                                                     reply.data.tobytes())
             raise DeviceError(errmsg)
-        elif not reply.is_checksum_good():
-            raise ValueError('Bad checksum in reply')
-        else:
-            return reply
+        return reply
 
     def enable_mca(self):
         """Enables the MCA.
@@ -143,35 +193,60 @@ class DP5Device(object):
         if reply.pid != pids.ACK_OK:
             raise UnexpectedReplyError(reply.pid)
 
-    def begin_acq(self, acqtime):
+    def begin_acq(self, acqtime, num_chans=None):
         """ Begins acquisition for a set time period.
 
+        The preset time and channel count are sent together in one CONFIG
+        packet, and only if they differ from the settings shadow, since every
+        CONFIG packet also makes the DP5 write its flash (up to 400 ms).  With
+        unchanged settings acquisition starts in two round trips.
+
+        The preset time is rounded to the DP5's resolution before it is
+        written, so the DP5 stores it unchanged and the shadow holds the
+        value the device uses without a readback.
+
         Args:
             acqtime (float): The time to acquire the spectrum.
+            num_chans (int, optional): Number of MCA channels to use.
         """
+        pret = preset_time(acqtime)
+        changes = {}
+        if not self._is_current('PRET', pret):
+            changes['PRET'] = pret
+        if num_chans is not None and not self._is_current('MCAC', num_chans):
+            changes['MCAC'] = int(num_chans)
+        if changes:
+            self.set_settings_dict(changes)
         self.clear_spectrum()
-        self.set_setting('PRET', acqtime)
         self.enable_mca()
 
-    def get_spectrum(self):
+    def get_spectrum(self, dtype=np.int64, priority=PRIORITY_READOUT):
         """Requests the spectrum in the buffer and status packet.
 
+        Args:
+            dtype: Integer NumPy dtype of the returned counts array, e.g.
+                np.uint32 for the most compact representation.
+            priority (int): Priority class of the request.
+
         Raises:
             UnexpectedReplyError: Reply is not a spectrum + status
                 packet.
 
-        Returns: A Spectrum object representing the reply received.
+        Returns: A tuple (counts, status) where `counts` is an ndarray of
+            counts per channel and `status` is the parsed status dict.
         """
-        reply = self.send(DP5Command(pids.GETSPECSTAT))
-        try:
-            numchans = pids.SPEC_CHAN[reply.pid]
-        except KeyError:
-            raise UnexpectedReplyError(reply.pid)
-        specdata = reply.data[:numchans*3]
-        spectrum = [byte2int(specdata[i:i+3]) for i in range(0,len(specdata),3)]
-        statdata = reply.data[numchans*3:]
-        status = parse_status(statdata)
-        return spectrum, status
+        def parse(reply):
+            try:
+                numchans = pids.SPEC_CHAN[reply.pid]
+            except KeyError:
+                raise UnexpectedReplyError(reply.pid)
+            spectrum = decode_spectrum(reply.data, numchans, dtype)
+            status = parse_status(reply.data[numchans*3:].tobytes())
+            self.last_status = (time.time(), status)
+            return spectrum, status
+        return self.send(DP5Command(pids.GETSPECSTAT), parser=parse,
+                         priority=priority,
+                         merge_key=(pids.GETSPECSTAT, np.dtype(dtype).str))
         
     def clear_spectrum(self):
         """Clears the current MCA spectrum.
@@ -241,18 +316,26 @@ class DP5Device(object):
         """
         data = "{0}={1};".format(param.upper(), str(value))
         command1 = DP5Command(pids.CONFIG, data)
-        reply1 = self.send(command1)
-        if reply1.pid != pids.ACK_OK:
-            raise UnexpectedReplyError(reply1.pid)
+        def parse(reply1):
+            if reply1.pid != pids.ACK_OK:
+                raise UnexpectedReplyError(reply1.pid)
+            self._update_shadow({param: value})
+        # the outcome of a failed write is unknown, so forget the old value
+        self.send(command1, parser=parse,
+                  on_error=lambda: self._update_shadow({param: None}))
 
     def set_settings_dict(self, settings_dict):
         datastr = ''
         for param, value in settings_dict.iteritems():
             datastr += '{0}={1};'.format(param.upper(), value)
         command = DP5Command(pids.CONFIG, datastr)
-        reply = self.send(command)
-        if reply.pid != pids.ACK_OK:
-            raise DeviceError(reply.data)
+        def parse(reply):
+            if reply.pid != pids.ACK_OK:
+                raise DeviceError(reply.data.tobytes())
+            self._update_shadow(settings_dict)
+        # some of the settings may have been applied before an error
+        self.send(command, parser=parse, on_error=lambda: self._update_shadow(
+            dict.fromkeys(settings_dict)))
 
     def get_setting(self, arg):
         """Returns the value of a list of ASCII parameters.
@@ -273,61 +356,190 @@ class DP5Device(object):
         """
         param = arg.upper() + ';'
         command = DP5Command(pids.CONFIG_REQ, param)
-        reply = self.send(command)
-        if reply.pid != pids.CONFIG_READ:
-            raise UnexpectedReplyError(reply.pid)
-        res = reply.data.rstrip(';').split('=')[1]
-        return res
-
-    def get_settings_dict(self, params_list):
+        def parse(reply):
+            if reply.pid != pids.CONFIG_READ:
+                raise UnexpectedReplyError(reply.pid)
+            pairs = parse_settings(reply.data.tobytes())
+            self._store_shadow(pairs)
+            return pairs[0][1]
+        return self.send(command, parser=parse)
+
+    def get_settings_dict(self, params_list, priority=PRIORITY_CONTROL):
         data = ''
         for param in params_list:
             data += param.upper() + ';'
+        return dict(self._readback(data, priority))
+
+    def _readback(self, data, priority=PRIORITY_CONTROL):
+        """Sends a configuration readback request and shadows the result.
+
+        Args:
+            data (str): Readback request, e.g. 'GAIN;MCAC;'.
+            priority (int): Priority class of the request.
+
+        Returns (list of tuples): (param, value) pairs in the order received.
+        """
         command = DP5Command(pids.CONFIG_REQ, data)
-        reply = self.send(command)
-        if reply.pid != pids.CONFIG_READ:
-            raise UnexpectedReplyError(reply.pid)
-        res = reply.data.rstrip(';').split(';')
-        settings_dict = {}
-        for s in res:
-            key, value = s.split('=')
-            settings_dict[key] = value
-        return settings_dict
+        def parse(reply):
+            if reply.pid != pids.CONFIG_READ:
+                raise UnexpectedReplyError(reply.pid)
+            pairs = parse_settings(reply.data.tobytes())
+            self._store_shadow(pairs)
+            return pairs
+        return self.send(command, parser=parse, priority=priority,
+                         merge_key=(pids.CONFIG_REQ, data))
+
+    def cached_setting(self, param):
+        """Returns the value of an ASCII setting from the settings shadow.
+
+        The device is only queried if the setting is not in the shadow.
+        """
+        param = param.upper()
+        try:
+            return self._shadow[param]
+        except KeyError:
+            return self.get_setting(param)
+
+    def cached_settings_dict(self, params_list, priority=PRIORITY_CONTROL):
+        """Returns a dict of settings from the settings shadow.
+
+        Settings that are not shadowed are read from the device in a single
+        request.  The values read are returned directly, so the result is
+        complete even if another thread invalidates the shadow meanwhile.
+        """
+        params = [param.upper() for param in params_list]
+        shadow = dict(self._shadow)
+        settings = {param: shadow[param] for param in params
+                    if param in shadow}
+        missing = [param for param in params if param not in settings]
+        if missing:
+            settings.update(self.get_settings_dict(missing, priority))
+        return settings
+
+    def resync_settings(self):
+        """Discards the settings shadow and reloads it from the device."""
+        params = set(self._shadow) | set(pids.SHADOW_PRELOAD)
+        self._clear_shadow()
+        self.get_settings_dict(sorted(params))
+        self._sernum = self.get_status()['serial number']
+
+    def _is_current(self, param, value):
+        """Returns True if the shadow shows `param` already set to `value`."""
+        current = self._shadow.get(param)
+        if current is None:
+            return False
+        try:
+            return float(current) == float(value)
+        except ValueError:
+            return current == str(value).upper()
+
+    def _clear_shadow(self):
+        self._shadow.clear()
+        self._sernum = None
+
+    def _store_shadow(self, pairs):
+        """Records (param, value) pairs read back from the device.
+
+        Must be called with the port held so that a readback cannot overwrite
+        the shadow entry of a setting written after it.
+        """
+        sca = None
+        for param, value in pairs:
+            if param == pids.SCA_INDEX:
+                sca = value
+            elif param not in pids.SCA_INDEXED:
+                self._shadow[param] = value
+            elif sca is not None:
+                self._shadow[param + sca] = value
+
+    def _update_shadow(self, settings_dict):
+        """Updates the shadow after settings were written to the device.
+
+        Settings the device stores verbatim, and preset times that are
+        already whole steps of its resolution, are written through; the
+        rest, along with any settings that depend on them, are invalidated.
+        A value of None invalidates the setting unconditionally.
+        """
+        for param, value in settings_dict.iteritems():
+            param = param.upper()
+            if param == 'RESC':
+                self._shadow.clear()
+                continue
+            if param in pids.SCA_INDEXED:
+                for name in list(self._shadow):
+                    if name[:4] in pids.SCA_INDEXED:
+                        del self._shadow[name]
+            if value is not None and (param in pids.VERBATIM_SETTINGS or
+                                      param == 'PRET' and
+                                      _is_preset_step(value)):
+                self._shadow[param] = str(value).upper()
+            else:
+                self._shadow.pop(param, None)
+            for dependent in pids.DEPENDENT_SETTINGS.get(param, ()):
+                self._shadow.pop(dependent, None)
 
     def get_all_settings(self):
-        """Return a dictionary of all settings of the detector."""
-        resp1 = self.get_settings_dict(pids.SETTINGS_LIST[0:18])
-        resp2 = self.get_settings_dict(pids.SETTINGS_LIST[18:36])
-        resp3 = self.get_settings_dict(pids.SETTINGS_LIST[36:])
-        settings_dict = {}
-        for d in (resp1, resp2, resp3):
-            settings_dict.update(d)
-        if settings_dict['RTDE'] == 'ON':
-            respr = self.get_settings_dict(pids.RTD_SETTINGS)
-            settings_dict.update(respr)
+        """Return a dictionary of all settings of the detector.
+
+        Only settings missing from the settings shadow are read back, packed
+        into as few readback packets as fit, so a repeat call with unchanged
+        settings makes no round trips.  SCA settings are keyed by SCA
+        number, e.g. 'SCAL3'.
+        """
+        self._read_missing([p + ';' for p in pids.SETTINGS_LIST])
+        names = list(pids.SETTINGS_LIST)
+        if self._shadow['RTDE'] == 'ON':
+            self._read_missing([p + ';' for p in pids.RTD_SETTINGS])
+            names += pids.RTD_SETTINGS
+        sca_requests = []
         for sca in range(1, 17):
-            self.set_setting(pids.SCA_INDEX, sca)
-            resps = self.get_settings_dict(pids.SCA_SETTINGS16)
-            for i in resps:
-                settings_dict.update(resps)
+            params = list(pids.SCA_SETTINGS16)
             if sca <= 8:
-                resps8 = {pids.SCA_OUTPUT:self.get_setting(pids.SCA_OUTPUT)}
-                settings_dict.update(resps)
-        return settings_dict
+                params.append(pids.SCA_OUTPUT)
+            sca_requests.append('{0}={1};'.format(pids.SCA_INDEX, sca) +
+                                ''.join(p + ';' for p in params))
+            names += [p + str(sca) for p in params]
+        self._read_missing(sca_requests)
+        return {name: self._shadow.get(name) for name in names}
+
+    def _read_missing(self, requests):
+        """Reads back the requests whose settings are not all shadowed.
 
-    def get_status(self):
+        Args:
+            requests (list of strs): Readback requests such as 'GAIN;' or
+                'SCAI=3;SCAH;SCAL;'.  Each request is kept within a single
+                packet.
+        """
+        missing = [r for r in requests
+                   if not all(name in self._shadow
+                              for name in readback_names(r))]
+        for data in pack_readback(missing):
+            self._readback(data)
+
+    def get_status(self, priority=PRIORITY_CONTROL):
         """Requests a status packet from the detector.
 
+        Args:
+            priority (int): Priority class of the request.
+
         Returns (dict): Parsed detector status information."""
-        reply = self.send(pids.GETSTAT)
+        reply = self.send(pids.GETSTAT, priority=priority,
+                          merge_key=pids.GETSTAT)
         if reply.pid != pids.STATUS:
             raise UnexpectedReplyError(reply.pid)
-        return parse_status(reply.data)
+        status = parse_status(reply.data)
+        self.last_status = (time.time(), status)
+        if status['first packet since reboot']:
+            self._clear_shadow()
+        self._sernum = status['serial number']
+        return status
 
     @property
     def sernum(self):
         """Returns the detector serial number (int)"""
-        return self.get_status()['serial number']
+        if self._sernum is None:
+            self.get_status()
+        return self._sernum
 
     @property
     def calibration(self):
@@ -344,7 +556,7 @@ class DP5Device(object):
     @property
     def gain(self):
         """Returns total amplifier gain."""
-        return float(self.get_setting("GAIN"))
+        return float(self.cached_setting("GAIN"))
 
     @gain.setter
     def gain(self, g):
@@ -354,7 +566,7 @@ class DP5Device(object):
     @property
     def num_chans(self):
         """Returns the number of MCA channels in use."""
-        return int(self.get_setting("MCAC"))
+        return int(self.cached_setting("MCAC"))
 
     #def chan2energy(self, chan):
         #"""Convert from channel number to channel energy.
@@ -472,9 +684,17 @@ class DP5Reply(object):
 
     def encode(self):
         """Returns the reply as a binary string in the form it was received."""
-        return (pids.SYNC + self.pid + self.length + self.data +
+        return (pids.SYNC + self.pid + self.length + _tobytes(self.data) +
                 self.checksum)
 
+    def detach(self):
+        """Copies the data field out of the receive buffer, if necessary.
+
+        Returns (DP5Reply): This reply.
+        """
+        self.data = _tobytes(self.data)
+        return self
+
     def is_checksum_good(self):
         """Verifies that the checksum from the reply is valid.
 
@@ -491,6 +711,259 @@ class DP5Reply(object):
         packetsum = add16b(ints)
         return add16b((packetsum, intchecksum)) == 0
 
+class RequestScheduler(object):
+    """Grants exclusive use of the DP5 port to requests in priority order.
+
+    Requests run in order of priority class, and in order of arrival within a
+    class.  A request submitted with the merge key of a request that is still
+    waiting joins it instead of queueing a duplicate, promoting it to the more
+    urgent of the two priorities.
+
+    Attributes:
+        max_depth (int): Largest number of requests seen waiting at once.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._waiting = []  # [priority, sequence number, merge key] entries
+        self._pending = {}  # merge key -> _Request waiting for the port
+        self._seq = 0
+        self._busy = False
+        self.max_depth = 0
+        self._stats = {p: {'requests': 0, 'merged': 0, 'total wait': 0.,
+                           'max wait': 0.} for p in PRIORITIES}
+
+    def run(self, func, priority=PRIORITY_CONTROL, merge_key=None):
+        """Calls `func` while holding the port and returns its result.
+
+        Blocks until all more urgent and earlier requests are finished.
+        Exceptions raised by `func` are raised in every merged caller.
+        """
+        queued = time.time()
+        with self._cond:
+            request = self._pending.get(merge_key)
+            if merge_key is not None and request is not None:
+                request.ticket[0] = min(request.ticket[0], priority)
+                self._stats[priority]['merged'] += 1
+                while not request.done:
+                    self._cond.wait()
+                self._record_wait(priority, queued)
+                return request.get()
+            self._seq += 1
+            request = _Request([priority, self._seq])
+            self._waiting.append(request.ticket)
+            if merge_key is not None:
+                self._pending[merge_key] = request
+            self.max_depth = max(self.max_depth, len(self._waiting))
+            while self._busy or min(self._waiting) is not request.ticket:
+                self._cond.wait()
+            self._waiting.remove(request.ticket)
+            if merge_key is not None:
+                del self._pending[merge_key]
+            self._busy = True
+            self._record_wait(priority, queued)
+        try:
+            request.result = func()
+        except Exception as e:
+            request.error = e
+        finally:
+            with self._cond:
+                self._busy = False
+                request.done = True
+                self._cond.notify_all()
+        return request.get()
+
+    def _record_wait(self, priority, queued):
+        wait = time.time() - queued
+        stats = self._stats[priority]
+        stats['requests'] += 1
+        stats['total wait'] += wait
+        stats['max wait'] = max(stats['max wait'], wait)
+
+    def get_stats(self):
+        """Returns a snapshot of the scheduler statistics.
+
+        Returns (dict): Contains 'depth' (requests currently waiting),
+            'max depth', and for each priority class a dict of 'requests'
+            served, 'merged' requests, and 'total wait', 'mean wait' and
+            'max wait' times in seconds.
+        """
+        with self._cond:
+            snapshot = {'depth': len(self._waiting),
+                        'max depth': self.max_depth}
+            for priority, stats in self._stats.iteritems():
+                stats = dict(stats)
+                stats['mean wait'] = (stats['total wait']/stats['requests']
+                                      if stats['requests'] else 0.)
+                snapshot[priority] = stats
+        return snapshot
+
+
+class _Request(object):
+    """A request waiting for or holding the port in a RequestScheduler."""
+
+    def __init__(self, ticket):
+        self.ticket = ticket
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class PacketReader(object):
+    """Frames DP5 reply packets out of a reusable receive buffer.
+
+    Bytes are pulled from the serial port in bulk into a preallocated
+    bytearray, packets are located and checksummed in place, and the data
+    field of each reply is handed out as a memoryview rather than a copy.
+
+    Attributes:
+        port (serial.Serial): Port from which packets are read.
+    """
+
+    def __init__(self, port, bufsize=2*MAX_PACKET_LEN):
+        self.port = port
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0  # index of first unconsumed byte
+        self._end = 0    # index one past last received byte
+
+    def reset(self):
+        """Discards any buffered bytes."""
+        self._start = self._end = 0
+
+    def _fill(self, nbytes):
+        """Reads until at least `nbytes` unconsumed bytes are buffered.
+
+        Returns: True if the bytes are available, False if the port timed out.
+        """
+        while self._end - self._start < nbytes:
+            if self._start == self._end:
+                self._start = self._end = 0
+            elif len(self._buf) - self._start < nbytes:
+                # move the partial packet to the front to make room
+                remaining = self._end - self._start
+                self._buf[:remaining] = self._buf[self._start:self._end]
+                self._start, self._end = 0, remaining
+            needed = nbytes - (self._end - self._start)
+            free = len(self._buf) - self._end
+            count = min(free, max(needed, self.port.in_waiting))
+            nread = self.port.readinto(self._view[self._end:self._end+count])
+            self._end += nread
+            if nread < count:
+                return self._end - self._start >= nbytes
+        return True
+
+    def read(self):
+        """Reads the next packet from the port.
+
+        Raises:
+            TimeoutError: Read timed out before a full packet arrived.
+            ValueError: Packet has a bad checksum.
+
+        Returns (DP5Reply): The packet received.  Its data field is a
+            memoryview that is only valid until the next call to `read`.
+        """
+        while True:
+            if not self._fill(6):
+                raise TimeoutError('Read timed out. Check detector connection.')
+            sync = self._buf.find(pids.SYNC, self._start, self._end)
+            if sync == self._start:
+                break
+            # discard bytes preceding the sync, keeping a possible half sync
+            self._start = sync if sync >= 0 else self._end - 1
+        start = self._start
+        datalen = (self._buf[start+4] << 8) + self._buf[start+5]
+        packetlen = datalen + 8
+        if not self._fill(packetlen):
+            raise TimeoutError('Read timed out.  Check detector connection.')
+        start = self._start
+        end = start + packetlen
+        self._start = end
+        packetsum = int(np.frombuffer(self._buf, dtype=np.uint8,
+                                      count=packetlen-2, offset=start).sum())
+        checksum = (self._buf[end-2] << 8) + self._buf[end-1]
+        if add16b((packetsum, checksum)) != 0:
+            raise ValueError('Bad checksum in reply')
+        return DP5Reply(str(self._buf[start:start+6]),
+                        self._view[start+6:end-2],
+                        str(self._buf[end-2:end]))
+
+
+def parse_settings(data):
+    """Parses a configuration readback string into (param, value) pairs.
+
+    Pairs are returned in the order received, since the meaning of SCA
+    settings depends on the SCAI directive preceding them.
+    """
+    pairs = []
+    for item in data.rstrip(';').split(';'):
+        key, value = item.split('=')
+        pairs.append((key, value))
+    return pairs
+
+
+def readback_names(request):
+    """Returns the shadow names of the settings read by a readback request.
+
+    SCA settings are named by SCA number, so 'SCAI=2;SCAL;SCAH;' reads
+    'SCAL2' and 'SCAH2'.
+    """
+    names = []
+    sca = None
+    for item in request.rstrip(';').split(';'):
+        param = item.split('=')[0]
+        if param == pids.SCA_INDEX:
+            sca = item.split('=')[1]
+        elif param in pids.SCA_INDEXED:
+            names.append(param + sca)
+        else:
+            names.append(param)
+    return names
+
+
+def pack_readback(requests):
+    """Packs readback requests into as few packet data fields as possible.
+
+    A packet is closed when either the request or the worst-case reply,
+    which is `pids.MAX_PARAM_LEN` characters per value, would exceed the
+    maximum data field length.
+
+    Args:
+        requests (list of strs): Readback requests, each ending in ';'.
+
+    Returns (list of strs): Data fields for CONFIG_REQ packets.
+    """
+    packets = []
+    data = ''
+    replylen = 0
+    for request in requests:
+        # each 'XXXX;' is answered by at most 'XXXX=<value>;'
+        req_replylen = len(request) + request.count(';')*(pids.MAX_PARAM_LEN+1)
+        if data and (len(data) + len(request) >= pids.MAX_DATA_LEN or
+                     replylen + req_replylen >= pids.MAX_DATA_LEN):
+            packets.append(data)
+            data = ''
+            replylen = 0
+        data += request
+        replylen += req_replylen
+    if data:
+        packets.append(data)
+    return packets
+
+
+def preset_time(acqtime):
+    """Returns (str): The PRET value for `acqtime` seconds, rounded to
+    `pids.PRESET_TIME_RESOLUTION` and at least one step, as the DP5
+    stores it."""
+    res = pids.PRESET_TIME_RESOLUTION
+    return '{0:.1f}'.format(max(round(acqtime/res), 1)*res)
+
+
 def parse_status(status_data):
     """Parses a DP5 status bytestring into a dict."""
     return {
@@ -542,20 +1015,77 @@ def parse_status(status_data):
     }
 
 
+def decode_spectrum(data, numchans, dtype=np.int64):
+    """Decodes the 24-bit little-endian channel counts of a spectrum packet.
+
+    The whole block is decoded at once by copying each 3-byte count into the
+    low bytes of a zeroed little-endian array, so the result is the only
+    allocation made.
+
+    Args:
+        data: A str, bytearray or memoryview whose first 3*`numchans` bytes
+            are the spectrum data.  Any trailing bytes (e.g. the status block
+            of a GETSPECSTAT reply) are ignored.
+        numchans (int): Number of channels in the spectrum.
+        dtype: Integer NumPy dtype of the result; must be at least 3 bytes
+            wide.
+
+    Returns (ndarray): Counts per channel.
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    if dtype.kind not in 'iu' or dtype.itemsize < 3:
+        raise ValueError('`dtype` must be an integer type of at least 3 bytes')
+    if isinstance(data, memoryview):
+        raw = np.asarray(data)[:3*numchans]
+    else:
+        raw = np.frombuffer(data, dtype=np.uint8, count=3*numchans)
+    counts = np.zeros(numchans, dtype=dtype)
+    counts.view(np.uint8).reshape(numchans, dtype.itemsize)[:, :3] = \
+        raw.reshape(numchans, 3)
+    return counts
+
+
 class StatusThread(threading.Thread):
-    def __init__(self, det):
+    """Publishes detector status and settings to `det.status_queue`.
+
+    Status packets that other requests (e.g. spectrum reads during a scan)
+    have already received are republished together with shadowed settings.
+    The thread only polls the device itself once the port has been idle for
+    `idle_interval` seconds.
+
+    Attributes:
+        det (DP5Device): Detector whose status is published.
+        interval (float): Seconds between publications.
+        idle_interval (float): Seconds of port inactivity after which the
+            thread polls the device itself.
+    """
+    def __init__(self, det, interval=0.5, idle_interval=0.5):
         super(StatusThread, self).__init__()
         self._stopper = threading.Event()
         self.det = det
+        self.interval = interval
+        self.idle_interval = idle_interval
         self.daemon = True
 
     def run(self):
         sets = ['PRET', 'MCAC', 'THSL', 'THFA', 'GAIN', 'TPEA', 'TECS']
+        published = 0.
         while not self._stopper.is_set():
-            status = self.det.get_status()
-            settings = self.det.get_settings_dict(sets)
+            received, status = self.det.last_status
+            if received > published:
+                settings = self.det.cached_settings_dict(
+                    sets, PRIORITY_HOUSEKEEPING)
+            elif time.time() - self.det.last_io >= self.idle_interval:
+                status = self.det.get_status(PRIORITY_HOUSEKEEPING)
+                settings = self.det.get_settings_dict(sets,
+                                                      PRIORITY_HOUSEKEEPING)
+                received = self.det.last_status[0]
+            else:
+                self._stopper.wait(0.05)
+                continue
+            published = received
             self.det.status_queue.put((status, settings))
-            time.sleep(0.5)
+            self._stopper.wait(self.interval)
 
     def stop(self):
         self._stopper.set()
@@ -601,3 +1131,20 @@ def byte2int(bytestring, little_endian=True, signed=False):
     for i in range(len(bytestring)):
         result += (1<<bytesize)**places[i]*unpacked[i]
     return result
+
+
+def _is_preset_step(value):
+    """Returns True if the PRET `value` is a positive whole number of
+    resolution steps, which the DP5 stores without rounding."""
+    try:
+        steps = float(value)/pids.PRESET_TIME_RESOLUTION
+    except ValueError:
+        return False
+    return steps >= 1 and abs(steps - round(steps)) < 1e-6
+
+
+def _tobytes(data):
+    """Returns a str copy of `data` if it is a memoryview, else `data`."""
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
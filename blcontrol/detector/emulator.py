@@ -0,0 +1,446 @@
+""" This module emulates an Amptek DP5 on a pseudo-terminal.
+
+`DP5Emulator` serves the DP5 packet protocol (sync, PID, length, data and
+checksum) on the slave end of a pty, so that `dp5io.DP5Device` can be run
+unmodified, e.g. for benchmarks, on a machine with no detector attached:
+
+    emu = DP5Emulator()
+    emu.start()
+    det = DP5Device(emu.config())
+    ...
+    det.disconnect()
+    emu.stop()
+
+Replies are paced at the emulated baud rate, and each command takes a fixed
+turnaround latency plus, for CONFIG packets, the time the DP5 spends writing
+its flash.  Acquisition is simulated in real time with Poisson counts drawn
+from a fixed model spectrum.
+"""
+
+import ConfigParser
+import numpy as np
+import os
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+from detector import pids
+from detector.dp5io import add16b
+
+## Default values of the ASCII settings, as read back from the device
+DEFAULT_SETTINGS = {
+    'AINP': 'POS', 'AUO1': 'ICR', 'AUO2': 'ICR', 'BLRD': '3', 'BLRM': '1',
+    'BLRU': '1', 'BOOT': 'ON', 'CLCK': '80', 'CLKL': 'ON', 'CUSP': '0',
+    'DACF': '50', 'DACO': 'SHAPED', 'GAIA': '3', 'GAIF': '0.9853',
+    'GAIN': '10.074', 'GATE': 'OFF', 'GPED': 'RI', 'GPGA': 'ON',
+    'GPIN': 'AUX1', 'GPMC': 'ON', 'GPME': 'ON', 'HVSE': '-110',
+    'INOF': 'DEF', 'MCAC': '1024', 'MCAE': 'OFF', 'MCAS': 'NORM',
+    'MCSH': '1023', 'MCSL': '0', 'MCST': '0', 'PAPS': 'ON', 'PDMD': 'NORM',
+    'PRCH': '1023', 'PRCL': '0', 'PREC': 'OFF', 'PRER': 'OFF',
+    'PRET': 'OFF', 'PURE': 'ON', 'RESL': '1', 'RTDD': '0', 'RTDE': 'OFF',
+    'RTDS': '0', 'RTDT': '0.00', 'RTDW': '0', 'SCAW': '100', 'SCOE': 'RI',
+    'SCOG': '1', 'SCOT': '50', 'SOFF': '0', 'SYNC': 'INT', 'TECS': '220',
+    'TFLA': '0.200', 'THFA': '20.00', 'THSL': '0.977', 'TLLD': 'OFF',
+    'TPEA': '4.000', 'TPFA': '100', 'TPMO': 'OFF',
+    }
+
+## Coarse analog gains selected by GAIA; the total gain is GAIA*GAIF
+COARSE_GAINS = [1.12, 2.49, 5.15, 10.22, 22.75, 47.67]
+FINE_GAIN_RANGE = (0.75, 1.25)
+
+NUM_SCAS = 16
+NUM_SCA_OUTPUTS = 8
+
+## Model spectrum: a flat background plus (fraction of full scale, relative
+## width, relative intensity) for each peak
+PEAKS = [(0.12, 0.004, 1.), (0.135, 0.004, 0.15), (0.42, 0.006, 0.4)]
+BACKGROUND = 0.1
+
+## Status block constants
+FIRMWARE_VERSION = 0x6B    # 6.11
+FPGA_VERSION = 0x64        # 6.04
+DEAD_FRACTION = 0.02       # fraction of real time not accumulated
+
+
+class DP5Emulator(threading.Thread):
+    """An emulated DP5 served on a pseudo-terminal.
+
+    Attributes:
+        port (str): Path of the pty to open as the detector's serial port.
+        baudrate (int): Emulated baud rate, used to pace replies.
+        latency (float): Command turnaround time in seconds.
+        flash_time (float): Time in seconds a CONFIG packet takes to apply,
+            since the DP5 writes every configuration to its flash.
+        count_rate (float): Detected count rate (counts per second of
+            accumulation time).
+        sernum (int): Serial number reported in status packets.
+        requests (dict): Number of requests received, by PID.
+    """
+    def __init__(self, baudrate=115200, latency=0.002, flash_time=0.1,
+                 count_rate=5000., sernum=14845):
+        super(DP5Emulator, self).__init__()
+        self.daemon = True
+        self.baudrate = baudrate
+        self.latency = latency
+        self.flash_time = flash_time
+        self.count_rate = count_rate
+        self.sernum = sernum
+        self.requests = {}
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave, termios.TCSANOW)
+        self.port = os.ttyname(self._slave)
+        self._stopper = threading.Event()
+        self._handlers = {
+            pids.GETSTAT: self._get_status,
+            pids.GETSPEC: self._get_spectrum,
+            pids.GETSPECSTAT: self._get_spectrum_status,
+            pids.ARMSCOPE: self._arm_scope,
+            pids.GETSCOPE: self._get_scope,
+            pids.CONFIG: self._config,
+            pids.CONFIG_REQ: self._config_req,
+            pids.CLRSPEC: self._clear_spectrum,
+            pids.ENMCA: self._enable_mca,
+            pids.DISMCA: self._disable_mca,
+            pids.AUTOOFFS: self._acknowledge,
+            pids.SETBAUD: self._acknowledge,
+            pids.ECHO_REQ: self._echo,
+            }
+        self.reboot()
+
+    def config(self):
+        """Returns a ConfigParser for connecting a DP5Device to the emulator.
+
+        The calibration section for the emulated serial number is copied
+        from the beamline configuration defaults.
+        """
+        config = ConfigParser.SafeConfigParser()
+        config.add_section('Detector Port')
+        config.set('Detector Port', 'serialport', self.port)
+        config.set('Detector Port', 'timeout', '10')
+        config.set('Detector Port', 'baudrate', str(self.baudrate))
+        section = '{0} Calib'.format(self.sernum)
+        config.add_section(section)
+        config.set(section, 'calib_factor', '0.00315691059703')
+        config.set(section, 'offset', '-0.0439739471587')
+        return config
+
+    def reboot(self):
+        """Restores the default settings and clears the MCA."""
+        self.settings = dict(DEFAULT_SETTINGS)
+        self._sca_index = 1
+        self._scas = [{'SCAL': '0', 'SCAH': '0', 'SCAO': 'OFF'}
+                      for _ in range(NUM_SCAS)]
+        self._first_packet = True
+        self._scope_armed = False
+        self._mca_enabled = False
+        self._clear()
+
+    def run(self):
+        buf = ''
+        while not self._stopper.is_set():
+            ready = select.select([self._master], [], [], 0.1)[0]
+            if not ready:
+                continue
+            try:
+                buf += os.read(self._master, 4096)
+            except OSError:
+                break
+            while True:
+                packet, buf = _split_packet(buf)
+                if packet is None:
+                    break
+                self._handle(packet)
+
+    def stop(self):
+        """Stops serving and closes the pty."""
+        self._stopper.set()
+        if self.is_alive():
+            self.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _handle(self, packet):
+        """Executes a command packet and transmits the reply."""
+        start = time.time()
+        # the command reaches the device only once it has been transmitted
+        delay = self._wire_time(len(packet)) + self.latency
+        pid = packet[2:4]
+        data = packet[6:-2]
+        self.requests[pid] = self.requests.get(pid, 0) + 1
+        checksum = struct.unpack('>H', packet[-2:])[0]
+        if add16b(bytearray(packet[:-2])) + checksum & 0xFFFF:
+            reply = _ack(4)
+        elif pid not in self._handlers:
+            reply = _ack(2)
+        else:
+            self._update()
+            reply, busy = self._handlers[pid](data)
+            delay += busy
+        time.sleep(max(start + delay - time.time(), 0))
+        self._transmit(encode_packet(reply[0], reply[1]))
+
+    def _wire_time(self, nbytes):
+        """Time to transmit `nbytes` 8N1 bytes at the emulated baud rate."""
+        return 10.*nbytes/self.baudrate
+
+    def _transmit(self, packet):
+        """Writes `packet` to the pty no faster than the baud rate allows."""
+        start = time.time()
+        chunk = max(self.baudrate//10000, 1)*16
+        for i in range(0, len(packet), chunk):
+            # a chunk is available to the host once its last byte arrives
+            end = min(i + chunk, len(packet))
+            time.sleep(max(start + self._wire_time(end) - time.time(), 0))
+            os.write(self._master, packet[i:end])
+
+    ## MCA simulation ##
+
+    def _clear(self):
+        numchans = self._numchans()
+        self._counts = np.zeros(numchans, dtype=np.int64)
+        self._accum_time = 0.
+        self._real_time = 0.
+        self._fast_count = 0
+        self._preset_reached = False
+        self._last_update = time.time()
+
+    def _numchans(self):
+        return int(self.settings['MCAC'])
+
+    def _update(self):
+        """Advances the acquisition to the current time."""
+        now = time.time()
+        elapsed = now - self._last_update
+        self._last_update = now
+        if not self._mca_enabled or elapsed <= 0:
+            return
+        remaining = []   # real time left until each preset is reached
+        if self.settings['PRET'] not in ('OFF', '0'):
+            remaining.append((float(self.settings['PRET']) -
+                              self._accum_time)/(1 - DEAD_FRACTION))
+        if self.settings['PRER'] not in ('OFF', '0'):
+            remaining.append(float(self.settings['PRER']) - self._real_time)
+        if remaining and min(remaining) <= elapsed:
+            elapsed = max(min(remaining), 0)
+            self._mca_enabled = False
+            self._preset_reached = True
+        accum = elapsed*(1 - DEAD_FRACTION)
+        self._real_time += elapsed
+        self._accum_time += accum
+        expected = self.count_rate*accum*_model_spectrum(len(self._counts))
+        new = np.random.poisson(expected)
+        self._counts += new
+        self._fast_count += int(new.sum()/(1 - DEAD_FRACTION))
+
+    def _status_block(self):
+        """Encodes the 64-byte status block (Programmer's Guide sec 4.1)."""
+        accum_ms = int(round(self._accum_time*1000))
+        flags1 = ((self._preset_reached and self.settings['PRER'] != 'OFF')
+                  << 7 | self._mca_enabled << 5 | 1 << 3 |
+                  self._scope_armed << 2)
+        flags2 = (self._first_packet << 5 |
+                  (self.settings['CLCK'] == '80') << 1 | 1)
+        hv = int(round(2*float(self.settings['HVSE'])))
+        block = (struct.pack('<III', self._fast_count, int(self._counts.sum()),
+                             0) +
+                 chr(accum_ms % 100) +
+                 struct.pack('<I', accum_ms//100)[:3] +
+                 4*chr(0) +
+                 struct.pack('<I', int(self._real_time*1000)) +
+                 chr(FIRMWARE_VERSION) + chr(FPGA_VERSION) +
+                 struct.pack('<I', self.sernum) +
+                 struct.pack('>h', hv) +
+                 struct.pack('>H', int(10*float(self.settings['TECS']))) +
+                 struct.pack('<b', 35) +
+                 chr(flags1) + chr(flags2) + chr(0) +
+                 chr(1 << 5) + chr(0))
+        self._first_packet = False
+        return block + (64 - len(block))*chr(0)
+
+    ## Command handlers: each returns ((pid, data), busy time) ##
+
+    def _acknowledge(self, data):
+        return (pids.ACK_OK, ''), 0.
+
+    def _echo(self, data):
+        return (pids.ECHO_RES, data), 0.
+
+    def _get_status(self, data):
+        return (pids.STATUS, self._status_block()), 0.
+
+    def _get_spectrum(self, data):
+        pid, specdata = self._spectrum_data()
+        # spectrum-only PIDs precede the spectrum + status PIDs
+        return (pid[0] + chr(ord(pid[1]) - 1), specdata), 0.
+
+    def _get_spectrum_status(self, data):
+        pid, specdata = self._spectrum_data()
+        return (pid, specdata + self._status_block()), 0.
+
+    def _spectrum_data(self):
+        """Returns the spectrum + status PID and the 24-bit counts."""
+        numchans = len(self._counts)
+        pid = [p for p, n in pids.SPEC_CHAN.items() if n == numchans][0]
+        counts = self._counts.astype('<u4').view(np.uint8)
+        return pid, counts.reshape(numchans, 4)[:, :3].tostring()
+
+    def _arm_scope(self, data):
+        self._scope_armed = True
+        return (pids.ACK_OK, ''), 0.
+
+    def _get_scope(self, data):
+        if not self._scope_armed:
+            return _ack(0x0a), 0.
+        self._scope_armed = False
+        trace = 32 + 160*np.exp(-((np.arange(2048) - 512)/100.)**2)
+        trace += np.random.normal(0, 1.5, trace.shape)
+        return (pids.SCOPEDATA,
+                np.clip(trace, 0, 255).astype(np.uint8).tostring()), 0.
+
+    def _clear_spectrum(self, data):
+        self._clear()
+        return (pids.ACK_OK, ''), 0.
+
+    def _enable_mca(self, data):
+        self._mca_enabled = True
+        self._preset_reached = False
+        return (pids.ACK_OK, ''), 0.
+
+    def _disable_mca(self, data):
+        self._mca_enabled = False
+        return (pids.ACK_OK, ''), 0.
+
+    def _config(self, data):
+        """Applies 'PARM=value;' settings, stopping at the first bad one."""
+        for item in data.rstrip(';').split(';'):
+            param, _, value = item.partition('=')
+            if not self._apply(param.strip().upper(), value.strip().upper()):
+                return (pids.ACK + chr(5), item), self.flash_time
+        if self._numchans() != len(self._counts):
+            self._clear()
+        return (pids.ACK_OK, ''), self.flash_time
+
+    def _config_req(self, data):
+        """Reads back 'PARM;' settings; 'SCAI=n;' selects the SCA read."""
+        reply = ''
+        for item in data.rstrip(';').split(';'):
+            param, _, value = item.partition('=')
+            param = param.strip().upper()
+            if param == pids.SCA_INDEX and value:
+                if not self._apply(param, value.strip()):
+                    return (pids.ACK + chr(5), item), 0.
+                reply += '{0}={1};'.format(param, self._sca_index)
+                continue
+            value = self._readback(param)
+            if value is None:
+                return (pids.ACK + chr(5), item), 0.
+            reply += '{0}={1};'.format(param, value)
+        return (pids.CONFIG_READ, reply), 0.
+
+    def _readback(self, param):
+        """Returns the value string of `param`, or None if it is invalid."""
+        if param == pids.SCA_INDEX:
+            return str(self._sca_index)
+        if param == pids.SCA_OUTPUT and self._sca_index > NUM_SCA_OUTPUTS:
+            return None
+        if param in pids.SCA_INDEXED:
+            return self._scas[self._sca_index - 1][param]
+        if param in pids.RTD_SETTINGS and self.settings['RTDE'] != 'ON':
+            return None
+        return self.settings.get(param)
+
+    def _apply(self, param, value):
+        """Sets one setting the way the DP5 would.  Returns False if invalid.
+        """
+        if not value or (param not in self.settings and
+                         param not in pids.SCA_INDEXED and param != 'RESC'):
+            return False
+        if param in pids.RTD_SETTINGS and self.settings['RTDE'] != 'ON':
+            return False
+        try:
+            if param == 'RESC':
+                self.reboot()
+                self._first_packet = False
+            elif param == pids.SCA_INDEX:
+                index = int(value)
+                if not 1 <= index <= NUM_SCAS:
+                    return False
+                self._sca_index = index
+            elif param in pids.SCA_INDEXED:
+                if (param == pids.SCA_OUTPUT and
+                        self._sca_index > NUM_SCA_OUTPUTS):
+                    return False
+                self._scas[self._sca_index - 1][param] = value
+            elif param == 'MCAC':
+                if int(value) not in pids.SPEC_CHAN.values():
+                    return False
+                self.settings[param] = str(int(value))
+            elif param == 'GAIN':
+                self._set_gain(float(value))
+            elif param == 'GAIA':
+                self.settings['GAIA'] = str(int(value))
+                self._set_gain(None)
+            elif param == 'GAIF':
+                self.settings['GAIF'] = '{0:.4f}'.format(float(value))
+                self._set_gain(None)
+            elif param in ('TPEA', 'TFLA'):
+                self.settings[param] = '{0:.3f}'.format(float(value))
+            else:
+                self.settings[param] = value
+        except (ValueError, IndexError):
+            return False
+        return True
+
+    def _set_gain(self, gain):
+        """Splits `gain` into coarse and fine gain, or recomputes the total
+        gain from them if `gain` is None."""
+        if gain is not None:
+            fine = [gain/coarse for coarse in COARSE_GAINS]
+            index = int(np.argmin([abs(f - 1) for f in fine]))
+            self.settings['GAIA'] = str(index)
+            self.settings['GAIF'] = '{0:.4f}'.format(
+                np.clip(fine[index], *FINE_GAIN_RANGE))
+        total = (COARSE_GAINS[int(self.settings['GAIA'])] *
+                 float(self.settings['GAIF']))
+        self.settings['GAIN'] = '{0:.3f}'.format(total)
+
+
+def _model_spectrum(numchans):
+    """Returns the fraction of counts falling in each channel."""
+    x = np.linspace(0, 1, numchans, endpoint=False)
+    shape = np.full(numchans, BACKGROUND/numchans)
+    for center, width, height in PEAKS:
+        shape += height*np.exp(-0.5*((x - center)/width)**2)/numchans
+    return shape/shape.sum()
+
+
+def _split_packet(buf):
+    """Splits the first complete packet off `buf`.
+
+    Bytes before the first sync are discarded.
+
+    Returns (tuple): (packet, remaining), where `packet` is None if `buf`
+        does not yet hold a complete packet.
+    """
+    start = buf.find(pids.SYNC)
+    if start < 0:
+        return None, buf[-1:]
+    buf = buf[start:]
+    if len(buf) < 6:
+        return None, buf
+    end = 8 + struct.unpack('>H', buf[4:6])[0]
+    if len(buf) < end:
+        return None, buf
+    return buf[:end], buf[end:]
+
+
+def _ack(code):
+    return (pids.ACK + chr(code), '')
+
+
+def encode_packet(pid, data):
+    """Encodes a packet of any length, including spectrum replies."""
+    packet = pids.SYNC + pid + struct.pack('>H', len(data)) + data
+    return packet + struct.pack('>H', -add16b(bytearray(packet)) & 0xFFFF)
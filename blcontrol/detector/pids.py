@@ -76,6 +76,10 @@ SCOPE_TB_FPGA80 = {
     (13.20, 25.60): 0.2
 }
 
+## Maximum length of a packet data field, and of a single ASCII setting value
+MAX_DATA_LEN = 512
+MAX_PARAM_LEN = 10
+
 ### Settings to be set or printed by a settings import/export.
 ### See DP5 Programmer's Guide, sec 7, for the meaning of these settings.
 SETTINGS_LIST = [
@@ -107,3 +111,28 @@ SCA_OUTPUT = "SCAO"   ### SCA output, only for SCAs 1-8
 
 ### Settings related to SCAs 1-16.
 SCA_SETTINGS16 = ['SCAH', 'SCAL']
+
+### Settings whose value depends on the current SCA index.
+SCA_INDEXED = [SCA_INDEX, SCA_OUTPUT] + SCA_SETTINGS16
+
+### Settings the DP5 stores exactly as written, so that a write can update
+### the settings shadow in `dp5io.DP5Device` without a readback.  Writing
+### any other setting invalidates its shadowed value instead.  PRET is not
+### one of them: the DP5 rounds it to PRESET_TIME_RESOLUTION, so only values
+### that are already whole steps are shadowed as written.
+VERBATIM_SETTINGS = ['MCAC', 'MCAE', 'MCAS', 'PRCH', 'PRCL', 'PREC', 'PRER',
+                     'RTDE']
+
+### Resolution (seconds) of the preset time PRET.
+PRESET_TIME_RESOLUTION = 0.1
+
+### Settings whose values change when the keyed setting is written.
+DEPENDENT_SETTINGS = {
+    'CLCK': ['TFLA', 'TPEA', 'TPFA'],
+    'GAIA': ['GAIN'],
+    'GAIF': ['GAIN'],
+    'GAIN': ['GAIA', 'GAIF'],
+    }
+
+### Settings loaded into the shadow by `DP5Device.resync_settings`.
+SHADOW_PRELOAD = ['GAIN', 'MCAC']
@@ -62,8 +62,7 @@ class SingleMotorWidget(ttk.Frame):
 
     def home_and_reenable(self):
         """Restores pos info and enables entry."""
-        self.motor.send(com.HOME)
-        self.motor.get_reply(com.HOME)
+        self.motor.send(com.HOME).result()
         self.goto.configure(state='normal')
         self.zerobutt.configure(text='Zero', command=self.motor.zero_here)
         self.motor.send(com.POS)
@@ -45,6 +45,8 @@ class LinearScanSettings(ScanSettingsFrame):
         keys = ['motorname', 'acctime', 'stepsize', 'start', 'end']
         self.variables = {key: StringVar() for key in keys}
         self.stepunit = StringVar(value=' mm')
+        self.fly = BooleanVar(value=False)
+        self.adaptive = BooleanVar(value=False)
         self.make_widgets()
 
     def make_widgets(self):
@@ -91,6 +93,20 @@ class LinearScanSettings(ScanSettingsFrame):
         lab2.pack(side=LEFT)
         extframe.pack(side=TOP, fill=BOTH, expand=1, pady=3)
 
+        flybutt = ttk.Checkbutton(self, text='Fly scan', variable=self.fly)
+        flybutt.pack(side=TOP, anchor=W, pady=3)
+        adaptbutt = ttk.Checkbutton(self, text='Adaptive (refine peak)',
+                                    variable=self.adaptive)
+        adaptbutt.pack(side=TOP, anchor=W, pady=3)
+
+    def get_params(self):
+        """Return scan parameters, including whether to fly scan or refine
+        adaptively."""
+        params = ScanSettingsFrame.get_params(self)
+        params['fly'] = self.fly.get()
+        params['adaptive'] = self.adaptive.get()
+        return params
+
     def change_unit(self, _):
         """Toggle between linear and angular units based on motor travel."""
         self.motorsel.selection_clear()
@@ -109,6 +125,7 @@ class GridScanSettings(ScanSettingsFrame):
         self.scantype = 'grid'
         keys = ['acctime', 'stepsize', 'gridsize']
         self.variables = {key: StringVar() for key in keys}
+        self.adaptive = BooleanVar(value=False)
         self.make_widgets()
 
     def make_widgets(self):
@@ -130,7 +147,8 @@ class GridScanSettings(ScanSettingsFrame):
         stepsizeframe.pack(side=TOP, fill=BOTH, expand=1, pady=3)
 
         gridsizeframe = ttk.Frame(self)
-        vals = ['{0}x{0}'.format(i).center(6) for i in range(3, 13, 2)]
+        vals = ['{0}x{0}'.format(i).center(6) for i in
+                range(3, 13, 2) + [15, 21, 31]]
         ttk.Label(gridsizeframe, text='Grid size: ').pack(side=LEFT)
         gridsizesel = ttk.Combobox(gridsizeframe, values=vals, width=5,
             state='readonly')
@@ -142,6 +160,16 @@ class GridScanSettings(ScanSettingsFrame):
         gridsizesel.bind('<<ComboboxSelected>>', gridcallback)
         gridsizesel.pack(side=LEFT)
         gridsizeframe.pack(side=TOP, fill=BOTH, expand=1, pady=3)
+
+        adaptbutt = ttk.Checkbutton(self, text='Adaptive (refine beam)',
+                                    variable=self.adaptive)
+        adaptbutt.pack(side=TOP, anchor=W, pady=3)
+
+    def get_params(self):
+        """Return scan parameters, including whether to refine adaptively."""
+        params = ScanSettingsFrame.get_params(self)
+        params['adaptive'] = self.adaptive.get()
+        return params
         
 
 class SpectrumSettings(ScanSettingsFrame):
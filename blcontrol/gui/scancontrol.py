@@ -10,7 +10,8 @@ else:
 from scan_settings import SettingsFrame
 from plot_windows import SpectrumDisplay, ScanDisplay
 from scan_threads import (SpectrumAcqThread, LinearScanThread,
-    GridScanThread)
+    AdaptiveLinearScanThread, FlyScanThread, GridScanThread,
+    AdaptiveGridScanThread)
     
 
 class ScanController(ttk.Frame):
@@ -74,17 +75,22 @@ class ScanController(ttk.Frame):
             self.specplot.stop_plot()
             self.scanplot.stop_plot()
             self.after_cancel(self.checker)
+            if self.last_scan.errors:
+                errmsg = '\n'.join('Move of {0} refused: {1}'.format(name, err)
+                                   for name, err in
+                                   sorted(self.last_scan.errors.items()))
+                messagebox.showerror('Scan Stopped', errmsg)
 
     def start_spectrum_acq(self, params):
         """Begin a spectrum acquisition based on settings frame parameters."""
-        num_chans = params['chans']
-        self.det.set_setting('MCAC', num_chans)
+        num_chans = int(params['chans'])
         samplename = params['samplename']
         self.specplot.ax.set_title(samplename)
         acctime = params['acctime']
         roi = params['roi']
         specqueue = Queue.Queue()
-        thread = SpectrumAcqThread(self.det, acctime, specqueue)
+        thread = SpectrumAcqThread(self.det, acctime, specqueue,
+                                   num_chans=num_chans)
         self.last_scan = thread
         thread.start()
         self.specplot.plot(specqueue, roi)
@@ -92,7 +98,6 @@ class ScanController(ttk.Frame):
 
     def start_linear_scan(self, params):
         """Begin a linear scan based on settings frame parameters."""
-        self.det.set_setting('MCAC', 256)
         motor = self.sio.motors[params['motorname']]
         start, end = params['start'], params['end']
         if not (motor.is_in_range(start) and motor.is_in_range(end)):
@@ -105,7 +110,16 @@ class ScanController(ttk.Frame):
             stepsize*= -1
         numpts = int((end - start)/stepsize + 1)
         locs = [start + stepsize*i for i in range(numpts)]
-        thread = LinearScanThread(self.det, motor, params['acctime'], locs)
+        if params.get('fly') and numpts > 1:
+            thread = FlyScanThread(self.det, motor, params['acctime'], locs,
+                                   num_chans=256)
+        elif params.get('adaptive'):
+            thread = AdaptiveLinearScanThread(self.det, motor,
+                                              params['acctime'], locs,
+                                              num_chans=256, roi=params['roi'])
+        else:
+            thread = LinearScanThread(self.det, motor, params['acctime'],
+                                      locs, num_chans=256)
         self.last_scan = thread
         thread.start()
         self.specplot.plot(thread.specqueue, params['roi'])
@@ -116,25 +130,30 @@ class ScanController(ttk.Frame):
 
     def start_grid_scan(self, params):
         """Begin a grid scan based on settings frame parameters."""
-        self.det.set_setting('MCAC', 256)
         dx = self.sio.motors['dx']
         dy = self.sio.motors['dy']
         stepsize = params['stepsize']
         gridsize = params['gridsize']
-        xlocs = [dx.pos - (gridsize-1)*stepsize/2.0 + i*stepsize for i in
+        x0, y0 = dx.pos, dy.pos
+        xlocs = [x0 - (gridsize-1)*stepsize/2.0 + i*stepsize for i in
                  range(int(gridsize))]
-        ylocs = [dy.pos - (gridsize-1)*stepsize/2.0 + i*stepsize for i in
+        ylocs = [y0 - (gridsize-1)*stepsize/2.0 + i*stepsize for i in
                  range(int(gridsize))]
-        if not (dy.is_in_range(ylocs[0]) and dy.is_in_range(ylocs[-1])):
+        if not dy.are_in_range(ylocs).all():
             errmsg = "Scan outside of limits of travel of dy"
             messagebox.showerror('Scan Limits', errmsg)
             return
-        if not (dx.is_in_range(xlocs[0]) and dx.is_in_range(xlocs[-1])):
+        if not dx.are_in_range(xlocs).all():
             errmsg = "Scan outside of limits of travel of dx"
             messagebox.showerror('Scan Limits', errmsg)
             return
-        thread = GridScanThread(self.det, self.sio, xlocs, ylocs,
-                                params['acctime'])
+        if params.get('adaptive'):
+            thread = AdaptiveGridScanThread(self.det, self.sio, xlocs, ylocs,
+                                            params['acctime'], num_chans=256,
+                                            roi=params['roi'])
+        else:
+            thread = GridScanThread(self.det, self.sio, xlocs, ylocs,
+                                    params['acctime'], num_chans=256)
         self.last_scan = thread
         thread.start()
         self.specplot.plot(thread.specqueue, params['roi'])
@@ -10,6 +10,7 @@ class Spectrum(object):
         self.status = status
         self.timestamp = timestamp
         self.samplename = None
+        self.settle_time = None
 
     def total_count(self):
         return sum(self.counts)
@@ -41,7 +42,11 @@ class Spectrum(object):
         header = (os.path.abspath(filename) + '\n' +
                   'MCA Spectrum ' + self.timestamp + '\n' +
                   samplename + '\n\nkeV       cts')
-        footer = '\nDetector status:\n'
+        footer = ''
+        if self.settle_time is not None:
+            footer += '\nStage settle time = {0:.3f} s\n'.format(
+                self.settle_time)
+        footer += '\nDetector status:\n'
         for key, value in self.status.iteritems():
             footer += '{0} = {1}\n'.format(key, value)
         footer += '\nDetector settings:\n'
@@ -57,9 +62,8 @@ class Spectrum(object):
         return cen_fwhm(self.roi_energies(roi), self.roi_counts(roi))
 
     def peakloc_max(self):
-        maximum = max(self.counts)
-        peakloc = self.energies[self.counts.index(maximum)]
-        return peakloc, maximum
+        maxind = np.argmax(self.counts)
+        return self.energies[maxind], self.counts[maxind]
 
     def roi_peakloc_max(self, roi):
         maximum = max(self.roi_counts(roi))
@@ -85,6 +89,11 @@ class LinearScan(object):
             locline += '{0:0.3f} '.format(x)
             spectrum = np.array([self.spectra[i].counts])
             outarr = np.append(outarr, spectrum, axis=0)
+        settle_times = [spec.settle_time for spec in self.spectra]
+        if any(t is not None for t in settle_times):
+            locline += '\nSettle times (s): '
+            for t in settle_times:
+                locline += '-- ' if t is None else '{0:0.3f} '.format(t)
         status = self.spectra[-1].status
         settings = self.spectra[-1].settings
         header = metadata + locline + '\n' + 'keV\tcounts'
@@ -183,6 +192,123 @@ class GridScan(object):
                    delimiter='')
                 
 
+class SparseGridScan(GridScan):
+    """Grid scan measured at the sample points of a quadtree of cells.
+
+    `cells` lists cells of the grid as (i0, i1, j0, j1) index ranges, in the
+    order they were made: a cell is followed later in the list by the
+    smaller cells it was split into.  Each cell is measured at its central
+    point and `spectra` maps the (i, j) index of each measured point to its
+    spectrum.  `counts` fills every cell with the counts at its centre,
+    smaller cells over larger ones, so the scan plots, and gives a centroid,
+    like a full grid.
+    """
+    def __init__(self, xlocs, ylocs, timestamp):
+        super(SparseGridScan, self).__init__(xlocs, ylocs, {}, timestamp)
+        self.cells = []
+
+    @staticmethod
+    def center(cell):
+        """Returns the (i, j) index of the point at which `cell` is
+        measured."""
+        i0, i1, j0, j1 = cell
+        return ((i0 + i1 - 1)//2, (j0 + j1 - 1)//2)
+
+    def _fill(self, values):
+        """Returns an array of the grid with each cell filled with the value
+        at its centre, or -1 if not measured."""
+        filled = -1*np.ones((len(self.xlocs), len(self.ylocs)))
+        for cell in self.cells:
+            index = self.center(cell)
+            if index in values:
+                i0, i1, j0, j1 = cell
+                filled[i0:i1, j0:j1] = values[index]
+        return filled
+
+    @property
+    def counts(self):
+        return self._fill({index: spectrum.total_count()
+                           for index, spectrum in self.spectra.items()})
+
+    def roi_counts(self, roi):
+        if not roi:
+            return self._fill({})
+        return self._fill({index: spectrum.roi_total_count(roi)
+                           for index, spectrum in self.spectra.items()})
+
+    def export(self, filename, samplename):
+        indices = sorted(self.spectra)
+        energycol = self.spectra[indices[0]].energies
+        outarr = np.array([energycol])
+        metadata = (os.path.abspath(filename) +'\n'+
+                    'Adaptive grid scan dx, dy' +' '+ self.timestamp +'\n'+
+                    samplename + '\n')
+        locline = 'Locations: '
+        for i, j in indices:
+            locline += '({0:0.3f}, {1:0.3f}) '.format(self.xlocs[i],
+                                                      self.ylocs[j])
+            spectrum = np.array([self.spectra[i, j].counts])
+            outarr = np.append(outarr, spectrum, axis=0)
+        header = metadata + locline + '\n' + 'keV\tcounts'
+        status = self.spectra[indices[-1]].status
+        settings = self.spectra[indices[-1]].settings
+        footer = '\nDetector status:\n'
+        for key, value in status.iteritems():
+            footer += '{0} = {1}\n'.format(key, value)
+        footer += '\nDetector settings:\n'
+        for key, value in settings.iteritems():
+            footer += '{0} = {1}\n'.format(key, value)
+        np.savetxt(filename, outarr.T, fmt='%9s', header=header, footer=footer,
+                   delimiter='')
+
+
+class PointScan(object):
+    """Spectra measured at the points of a ScanPlan.
+
+    `spectra[k]` is the spectrum at point `k` of the plan, or None if the
+    point was not measured.
+    """
+    def __init__(self, axes, points, spectra, timestamp):
+        self.axes = axes
+        self.points = points
+        self.spectra = spectra
+        self.timestamp = timestamp
+
+    @property
+    def measured(self):
+        """Numbers of the points with a spectrum."""
+        return [k for k, spec in enumerate(self.spectra) if spec is not None]
+
+    @property
+    def counts(self):
+        return [spec.total_count() if spec else -1 for spec in self.spectra]
+
+    def export(self, filename, samplename):
+        measured = self.measured
+        energycol = self.spectra[measured[0]].energies
+        outarr = np.array([energycol])
+        metadata = (os.path.abspath(filename) +'\n'+ 'Scan of ' +
+                    ', '.join(self.axes) +' '+ self.timestamp +'\n'+
+                    samplename + '\n')
+        locline = 'Locations: '
+        for k in measured:
+            locline += '({0}) '.format(', '.join('{0:0.3f}'.format(x)
+                                                for x in self.points[k]))
+            spectrum = np.array([self.spectra[k].counts])
+            outarr = np.append(outarr, spectrum, axis=0)
+        header = metadata + locline + '\n' + 'keV\tcounts'
+        status = self.spectra[measured[-1]].status
+        settings = self.spectra[measured[-1]].settings
+        footer = '\nDetector status:\n'
+        for key, value in status.iteritems():
+            footer += '{0} = {1}\n'.format(key, value)
+        footer += '\nDetector settings:\n'
+        for key, value in settings.iteritems():
+            footer += '{0} = {1}\n'.format(key, value)
+        np.savetxt(filename, outarr.T, fmt='%9s', header=header, footer=footer,
+                   delimiter='')
+
+
 def cen_fwhm(xdata, ydata):
     xdata = np.array(xdata)
     ydata = np.array(ydata, dtype=float)
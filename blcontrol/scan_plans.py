@@ -0,0 +1,232 @@
+"""Scan plans: the points of a multi-motor scan and the order to visit them.
+
+A plan is made by one of `line`, `grid`, `coupled`, `spiral` or `point_set`,
+and its path can be reordered with a path optimizer such as `serpentine` or
+`nearest_neighbour` to shorten the total travel time.
+"""
+
+import numpy as np
+
+## Largest plan whose nearest-neighbour path is improved by 2-opt exchanges
+TWO_OPT_MAX_POINTS = 1000
+
+class ScanPlan(object):
+    """Points to measure in a scan, and the order to visit them.
+
+    Attributes:
+        axes (list): Names of the motors moved.
+        points (numpy.ndarray): Positions in real units, one row per point
+            and one column per axis.
+        shape (tuple): Shape of the array of results, e.g. (nx, ny) for a
+            grid; (number of points,) for other plans.
+        order (numpy.ndarray): Numbers of the points in the order to visit
+            them.
+    """
+    def __init__(self, axes, points, shape=None, order=None):
+        self.axes = list(axes)
+        self.points = np.asarray(points, dtype=float).reshape(-1,
+                                                              len(self.axes))
+        if shape is None:
+            shape = (len(self.points),)
+        self.shape = tuple(shape)
+        if order is None:
+            order = np.arange(len(self.points))
+        self.order = np.asarray(order)
+        self._indices = zip(*np.unravel_index(np.arange(len(self.points)),
+                                              self.shape))
+
+    def __len__(self):
+        return len(self.points)
+
+    def index(self, k):
+        """Returns (tuple): The index in an array of `self.shape` at which to
+        store the result for point number `k`."""
+        return self._indices[k]
+
+    def targets(self, k):
+        """Returns (dict): Maps axis names to the positions of point `k`."""
+        return dict(zip(self.axes, self.points[k]))
+
+    def reordered(self, optimizer, *args, **kwargs):
+        """Returns a copy of the plan with the path found by `optimizer`.
+
+        Args:
+            optimizer: Function of the plan and any further arguments that
+                returns an order of its points, e.g. `serpentine`.
+        """
+        order = optimizer(self, *args, **kwargs)
+        return ScanPlan(self.axes, self.points, self.shape, order)
+
+    def in_range(self, motors):
+        """Returns (numpy.ndarray): Boolean array, True for each point in the
+        range of travel of all axes.
+
+        Args:
+            motors (dict): Maps motor names to Motor objects.
+        """
+        ok = np.ones(len(self.points), dtype=bool)
+        for col, axis in enumerate(self.axes):
+            ok &= motors[axis].are_in_range(self.points[:, col])
+        return ok
+
+    def travel_time(self, speeds, start=None):
+        """Estimates the time spent moving along the path.
+
+        All axes move at once, at constant speed; acceleration is ignored.
+
+        Args:
+            speeds (sequence): Speed of each axis in real units/s.
+            start (sequence, optional): Position of each axis before the
+                scan.  If None, the path starts at its first point.
+        """
+        path = self.points[self.order]
+        if start is not None:
+            path = np.vstack([start, path])
+        steps = np.abs(np.diff(path, axis=0))/np.asarray(speeds, dtype=float)
+        return steps.max(axis=1).sum() if len(steps) else 0.
+
+
+def line(axis, locs):
+    """Returns a plan of one axis stepping through `locs`."""
+    return ScanPlan([axis], np.reshape(locs, (-1, 1)))
+
+
+def grid(axes, locs):
+    """Returns a plan of all combinations of the locations of each axis.
+
+    Args:
+        axes (list): Names of the motors.
+        locs (list): A list of locations for each axis.
+
+    The result for locations `locs[0][i]`, `locs[1][j]`, ... is stored at
+    index (i, j, ...).  In the initial order the first axis varies fastest.
+    """
+    shape = tuple(len(l) for l in locs)
+    mesh = np.meshgrid(*locs, indexing='ij')
+    points = np.column_stack([m.ravel() for m in mesh])
+    order = np.ravel_multi_index(_snake(shape, reverse=False), shape)
+    return ScanPlan(axes, points, shape, order)
+
+
+def coupled(axes, locs):
+    """Returns a plan of axes moving together, e.g. a diagonal line.
+
+    Args:
+        axes (list): Names of the motors.
+        locs (list): A list of locations for each axis, all of equal length.
+    """
+    return ScanPlan(axes, np.column_stack(locs))
+
+
+def spiral(axes, center, step, num_points):
+    """Returns a plan of points along an Archimedean spiral.
+
+    Successive points, and successive turns of the spiral, are about `step`
+    apart.
+
+    Args:
+        axes (list): Names of the two motors.
+        center (tuple): Position of the center of the spiral.
+        step (float): Spacing of points in real units.
+        num_points (int): Number of points.
+    """
+    # radius r = step*theta/(2 pi); arc length ~ step*theta^2/(4 pi)
+    arc = step*np.arange(num_points)
+    theta = np.sqrt(4*np.pi*arc/step)
+    radius = step*theta/(2*np.pi)
+    points = np.column_stack([center[0] + radius*np.cos(theta),
+                              center[1] + radius*np.sin(theta)])
+    return ScanPlan(axes, points)
+
+
+def point_set(axes, points):
+    """Returns a plan of an explicit list of points, each a sequence of
+    positions of `axes`."""
+    return ScanPlan(axes, points)
+
+
+def serpentine(plan):
+    """Path optimizer visiting a grid row by row in alternating directions.
+
+    The first axis varies fastest.  Plans other than grids keep their order.
+    """
+    if len(plan.shape) == 1:
+        return np.arange(len(plan))
+    return np.ravel_multi_index(_snake(plan.shape), plan.shape)
+
+
+def nearest_neighbour(plan, speeds, start=None):
+    """Path optimizer going to the nearest unvisited point in time each step.
+
+    The time between points is the longest of the axes' travel times, since
+    all axes move at once.  For plans of up to `TWO_OPT_MAX_POINTS` points,
+    the path is then improved by reversing sections while that shortens it.
+
+    Args:
+        plan (ScanPlan): The plan to order.
+        speeds (sequence): Speed of each axis in real units/s.
+        start (sequence, optional): Position of each axis before the scan.
+            If None, the path starts at the plan's first point.
+    """
+    speeds = np.asarray(speeds, dtype=float)
+    points = plan.points/speeds   # positions in seconds of travel
+    unvisited = np.ones(len(points), dtype=bool)
+    order = np.empty(len(points), dtype=int)
+    if start is None:
+        current = points[0]
+    else:
+        current = np.asarray(start, dtype=float)/speeds
+    for n in range(len(points)):
+        cost = np.abs(points - current).max(axis=1)
+        cost[~unvisited] = np.inf
+        k = np.argmin(cost)
+        order[n] = k
+        unvisited[k] = False
+        current = points[k]
+    if len(points) <= TWO_OPT_MAX_POINTS:
+        order = _two_opt(points, order)
+    return order
+
+
+def _two_opt(points, order):
+    """Improves an open path by reversing sections while that shortens it.
+
+    `points` are in units of travel time, so distances are maximum norms.
+    """
+    def dist(a, b):
+        return np.abs(points[a] - points[b]).max(axis=-1)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(order) - 2):
+            a, b = order[i], order[i + 1]
+            c = order[i + 2:]
+            e = np.append(order[i + 3:], -1)
+            # reversing order[i+1:j+1] joins a-c and b-e instead of a-b, c-e
+            delta = dist(a, c) - dist(a, b)
+            has_e = e >= 0
+            delta[has_e] += (dist(b, e[has_e]) -
+                             dist(c[has_e], e[has_e]))
+            j = np.argmin(delta)
+            if delta[j] < -1e-12:
+                j += i + 2
+                order[i + 1:j + 1] = order[i + 1:j + 1][::-1].copy()
+                improved = True
+    return order
+
+
+def _snake(shape, reverse=True):
+    """Returns the indices of an array of `shape` with the first axis
+    varying fastest, as a tuple of index arrays.  If `reverse`, each pass
+    along an axis goes in the opposite direction to the previous one."""
+    indices = [(i,) for i in range(shape[0])]
+    for size in shape[1:]:
+        outer = []
+        for j in range(size):
+            if reverse and j % 2:
+                inner = indices[::-1]
+            else:
+                inner = indices
+            outer.extend(idx + (j,) for idx in inner)
+        indices = outer
+    return tuple(np.array(col) for col in zip(*indices))
@@ -1,8 +1,14 @@
+import bisect
 import numpy as np
 import threading
 import time
 import Queue
-from scan_data import Spectrum, LinearScan, GridScan
+from detector.dp5io import PRIORITY_READOUT, preset_time
+import stages.commands as com
+from stages.stageio import SettleDetector
+from scan_data import (Spectrum, LinearScan, GridScan, SparseGridScan,
+                       PointScan, cen_fwhm)
+import scan_plans
 
 class ScanThread(threading.Thread):
     """Base class for data acquisition threads.
@@ -14,6 +20,13 @@ class ScanThread(threading.Thread):
         specqueue: Queue to hold spectrum data for display separate from data
             plot
         data: Acquired data from acquisition
+        move (MoveHandle): The latest move of the stages, if any
+        profiles: Maps scan phases ('traverse' to the first point, 'step'
+            between points) to names of motion profiles to use
+        settle_tolerance: Distance (real units) from a point within which
+            the stages count as arrived once they stop changing position
+        errors: Maps motor names to the DeviceError of a refused move that
+            ended the scan
     """
     def __init__(self, det, acctime):
         super(ScanThread, self).__init__()
@@ -23,77 +36,477 @@ class ScanThread(threading.Thread):
         self.plotqueue = Queue.Queue()
         self.specqueue = Queue.Queue()
         self.data = None
+        self.move = None
+        self.profiles = {'traverse': 'traverse', 'step': 'fine-step'}
+        self.settle_tolerance = 0.
+        self.errors = {}
+        self._saved_settings = {}   # motor -> settings before the scan
         self.daemon = True
         self.name = "ScanThread"
 
     def stop(self):
         """Signal the thread to terminate after the current iteration."""
         self._stopper.set()
+        if self.move is not None:
+            self.move.stop()
         self.det.disable_mca()
 
     @property
     def is_stopped(self):
         return self._stopper.is_set()
 
+    def _use_profile(self, motors, phase):
+        """Applies the motion profile of a scan phase to `motors`.
+
+        Settings not in the profile are returned to their values before the
+        scan.  Only settings that change are sent.
+        """
+        for motor in motors:
+            settings = dict(self._saved_settings.get(motor, {}))
+            settings.update(motor.profiles.get(self.profiles.get(phase), {}))
+            self._change_settings(motor, settings)
+
+    def _change_settings(self, motor, settings):
+        """Applies settings to `motor`, keeping their values before the scan
+        to restore with `_restore_settings`."""
+        saved = self._saved_settings.setdefault(motor, {})
+        for setting, data in motor.apply_settings(settings).items():
+            saved.setdefault(setting, data)
+
+    def _restore_settings(self):
+        """Returns settings changed by `_use_profile` to their values before
+        the scan."""
+        for motor, saved in self._saved_settings.items():
+            motor.apply_settings(saved)
+        self._saved_settings = {}
+
+
+class Exposure(object):
+    """A single timed MCA acquisition.
+
+    Instead of reading the full spectrum every 0.5 s until the MCA stops, the
+    end of the acquisition is predicted from the preset time programmed,
+    which is `acctime` rounded to the DP5's resolution, and the accumulation
+    time reported in status packets.  The thread sleeps until
+    shortly before the predicted end, confirms it with lightweight GETSTAT
+    polls, and then reads the spectrum once.  Live spectra for display are
+    read on their own, independent schedule.
+
+    Attributes:
+        det: Detector to use for data acquisition
+        acctime: Accumulation time (seconds)
+        preset: Preset time (seconds) programmed for `acctime`
+        plotqueue: Queue to receive live spectra, or None
+        live_interval: Minimum time (seconds) between live spectrum reads
+        poll_interval: Time (seconds) between status polls near the end
+        data: Spectrum acquired
+    """
+    def __init__(self, det, acctime, plotqueue=None, live_interval=0.5,
+                 poll_interval=0.02):
+        self.det = det
+        self.acctime = acctime
+        self.preset = float(preset_time(acctime))
+        self.plotqueue = plotqueue
+        self.live_interval = live_interval
+        self.poll_interval = poll_interval
+        self.data = None
+        self._final = False
+
+    def start(self, num_chans=None):
+        """Clears the MCA and starts acquiring."""
+        self.det.begin_acq(self.acctime, num_chans)
+        self.started = time.time()
+        self.data = Spectrum([], self.det.get_energies(), {}, time.asctime())
+
+    def wait(self, stopper=None):
+        """Blocks until the MCA has stopped or `stopper` is set.
+
+        Args:
+            stopper (threading.Event, optional): Ends the wait early when set.
+        """
+        last_live = self.started
+        rate = 1.   # accumulation seconds per second of wall time
+        prev = None
+        while True:
+            now = time.time()
+            if (self.plotqueue is not None and
+                    now - last_live >= self.live_interval):
+                status = self._read_spectrum()
+                last_live = now
+            else:
+                status = self.det.get_status(PRIORITY_READOUT)
+            if not status['MCA enabled']:
+                return
+            if stopper is not None and stopper.is_set():
+                return
+            acc = status['accumulation time']
+            if prev is not None and now > prev[0] and acc > prev[1]:
+                rate = (acc - prev[1])/(now - prev[0])
+            prev = (now, acc)
+            remaining = (self.preset - acc)/rate
+            if self.plotqueue is not None:
+                remaining = min(remaining,
+                                last_live + self.live_interval - now)
+            delay = max(remaining, self.poll_interval)
+            if stopper is None:
+                time.sleep(delay)
+            elif stopper.wait(delay):
+                return
+
+    def read(self):
+        """Returns the final spectrum, reading it if not already read."""
+        if not self._final:
+            self._read_spectrum()
+        return self.data
+
+    def _read_spectrum(self):
+        self.data.counts, self.data.status = self.det.get_spectrum()
+        self._final = not self.data.status['MCA enabled']
+        if self.plotqueue is not None:
+            self.plotqueue.put(self.data)
+        return self.data.status
+
 
 class SpectrumAcqThread(ScanThread):
     """Thread for acquiring a single spectrum."""
-    def __init__(self, det, acctime, plotqueue, get_settings=True):
+    def __init__(self, det, acctime, plotqueue, get_settings=True,
+                 num_chans=None):
         super(SpectrumAcqThread, self).__init__(det, acctime)
         self.plotqueue = plotqueue
         self.get_settings = get_settings
+        self.num_chans = num_chans
 
     def run(self):
-        scandata = Spectrum([], self.det.get_energies(), {}, time.asctime())
-        self.det.begin_acq(self.acctime)
-        mca_enabled = True
+        exposure = Exposure(self.det, self.acctime, self.plotqueue)
+        exposure.start(self.num_chans)
         if self.get_settings:
-            scandata.settings = self.det.get_all_settings()
-        while mca_enabled:
-            scandata.counts, scandata.status = self.det.get_spectrum()
-            mca_enabled = scandata.status['MCA enabled']
-            self.plotqueue.put(scandata)
-            time.sleep(0.5)
-        self.data = scandata
+            exposure.data.settings = self.det.get_all_settings()
+        exposure.wait(self._stopper)
+        self.data = exposure.read()
         self.plotqueue.join()
         
 
+class StepScan(object):
+    """Acquires a spectrum at each of a sequence of stage positions.
+
+    Successive points are overlapped: as soon as the MCA stops at one point,
+    the move to the next point is started, and the spectrum is read and
+    handed to the caller while the stages travel.  The MCA is only enabled
+    once a SettleDetector reports that the stages have arrived at a point;
+    the time they took is kept in the `settle_time` of each spectrum.
+
+    Attributes:
+        det: Detector to use for data acquisition
+        acctime: Accumulation time (seconds) for individual spectra
+        specqueue: Queue to receive live spectra
+        num_chans: Number of MCA channels to use, or None to leave unchanged.
+        pipelined: If False, each point is moved to, measured and read in
+            turn, without overlap
+        settle_tolerance: Distance (real units) from a point within which
+            the stages count as arrived once they stop changing position
+        overheads: Wall time (seconds) beyond `acctime` spent on each point
+        errors: Maps motor names to the DeviceError of a refused move that
+            ended the scan
+    """
+    def __init__(self, det, acctime, specqueue, num_chans=None,
+                 pipelined=True, settle_tolerance=0.):
+        self.det = det
+        self.acctime = acctime
+        self.specqueue = specqueue
+        self.num_chans = num_chans
+        self.pipelined = pipelined
+        self.settle_tolerance = settle_tolerance
+        self.overheads = []
+        self.errors = {}
+
+    def run(self, points, start_move, stopper):
+        """Generates a (point, spectrum) tuple for each point measured.
+
+        All spectra share the detector settings read at the first point.
+        If a move is refused, `errors` is set, `stopper` is set to end the
+        scan, and the point is not measured.
+
+        Args:
+            points: List of stage positions, in any form accepted by
+                `start_move`
+            start_move: Function of a point and the scan phase, 'traverse'
+                for the first point and 'step' for the others, that starts
+                moving to the point and returns a MoveHandle
+            stopper (threading.Event): Ends the scan early when set.
+        """
+        self.overheads = []
+        self.errors = {}
+        settings = None
+        if points:
+            move = start_move(points[0], 'traverse')
+        for i, point in enumerate(points):
+            started = time.time()
+            settle_times = SettleDetector(move, self.settle_tolerance).wait()
+            if move.errors:
+                self.errors = {motor.name: error
+                               for motor, error in move.errors.items()}
+                stopper.set()
+            if stopper.is_set():
+                break
+            exposure = Exposure(self.det, self.acctime, self.specqueue)
+            exposure.start(self.num_chans)
+            if settings is None:
+                settings = self.det.get_all_settings()
+            exposure.wait(stopper)
+            has_next = i + 1 < len(points) and not stopper.is_set()
+            if self.pipelined and has_next:
+                move = start_move(points[i + 1], 'step')
+            spectrum = exposure.read()
+            spectrum.settings = settings
+            measured = [t for t in settle_times.values() if t is not None]
+            if measured:
+                spectrum.settle_time = max(measured)
+            yield point, spectrum
+            if not self.pipelined and has_next:
+                move = start_move(points[i + 1], 'step')
+            self.overheads.append(time.time() - started - self.acctime)
+
+
 class LinearScanThread(ScanThread):
     """Thread for acquring linear (single motor) scan data.
 
     Attributes:
         motor: Motor to move during acquisition
         locs: List of motor locations to collect spectra.
+        num_chans: Number of MCA channels to use, or None to leave unchanged.
+        overheads: Wall time (seconds) beyond `acctime` spent on each point
     """
-    def __init__(self, det, motor, acctime, locs):
+    def __init__(self, det, motor, acctime, locs, num_chans=None):
         super(LinearScanThread, self).__init__(det, acctime)
         self.motor = motor
         self.locs = locs
+        self.num_chans = num_chans
+        self.overheads = []
         self.name = "LinearScanThread"
 
     def run(self):
         scandata = LinearScan([], [], self.motor.name, time.asctime())
-        for i, l in enumerate(self.locs):
-            get_settings = not bool(i)
-            if self.is_stopped:
-                break
-            else:
-                mv_thread = self.motor.start_move(l)
-                mv_thread.join()
-                specthread = SpectrumAcqThread(self.det, self.acctime,
-                                               self.specqueue, get_settings)
-                specthread.start()
-                specthread.join()
-                spectrum = specthread.data
-                scandata.locations.append(l)
+        scan = StepScan(self.det, self.acctime, self.specqueue,
+                        self.num_chans, settle_tolerance=self.settle_tolerance)
+        try:
+            for loc, spectrum in scan.run(self.locs, self._move_to,
+                                          self._stopper):
+                scandata.locations.append(loc)
                 scandata.spectra.append(spectrum)
                 self.plotqueue.put(scandata)
-        settings = scandata.spectra[0].settings
-        for spec in scandata.spectra:
-            spec.settings = settings
+        finally:
+            self._restore_settings()
+        self.overheads = scan.overheads
+        self.errors = scan.errors
         self.data = scandata
         self.plotqueue.join()
 
+    def _move_to(self, loc, phase):
+        self._use_profile([self.motor], phase)
+        self.move = self.motor.start_move(loc)
+        return self.move
+
+
+class AdaptiveLinearScanThread(LinearScanThread):
+    """Thread for linear scans measuring only the points needed to locate a
+    peak.
+
+    `locs` is the finest set of locations that may be measured.  A coarse
+    pass measures every `coarse_stride`-th location and the last one.  Each
+    further pass measures the location in the middle of every interval
+    between measured points that holds the peak or a half-maximum crossing,
+    or across which the counts change by more than `max_change` of the peak
+    height.  Passes stop once the centre and FWHM from `cen_fwhm` each
+    change by no more than `tolerance`, or no interval can be split.
+
+    Attributes:
+        roi: Region of interest whose counts locate the peak, or None to use
+            total counts
+        coarse_stride: Spacing of the coarse pass in steps of `locs`
+        tolerance: Change (real units) in centre and FWHM between passes
+            below which the scan ends; half a step of `locs` if None
+        max_change: Fraction of the peak height by which counts may change
+            between neighbouring points
+        passes: Number of passes made
+    """
+    def __init__(self, det, motor, acctime, locs, num_chans=None, roi=None,
+                 coarse_stride=4, tolerance=None, max_change=0.25):
+        super(AdaptiveLinearScanThread, self).__init__(det, motor, acctime,
+                                                       locs, num_chans)
+        self.roi = roi
+        self.coarse_stride = coarse_stride
+        if tolerance is None and len(locs) > 1:
+            tolerance = abs(locs[1] - locs[0])/2.
+        self.tolerance = tolerance
+        self.max_change = max_change
+        self.passes = 0
+        self.name = "AdaptiveLinearScanThread"
+
+    def run(self):
+        scandata = LinearScan([], [], self.motor.name, time.asctime())
+        measured = []   # indices of measured points in self.locs, in order
+        todo = range(0, len(self.locs), self.coarse_stride)
+        if todo and todo[-1] != len(self.locs) - 1:
+            todo.append(len(self.locs) - 1)
+        previous = None
+        self.overheads = []
+        self.passes = 0
+        try:
+            while todo and not self.is_stopped:
+                # alternate directions so each pass starts near the last end
+                if self.passes % 2:
+                    todo.reverse()
+                scan = StepScan(self.det, self.acctime, self.specqueue,
+                                self.num_chans,
+                                settle_tolerance=self.settle_tolerance)
+                for i, spectrum in scan.run(todo, self._move_to_index,
+                                            self._stopper):
+                    n = bisect.bisect(measured, i)
+                    measured.insert(n, i)
+                    scandata.locations.insert(n, self.locs[i])
+                    scandata.spectra.insert(n, spectrum)
+                    self.plotqueue.put(scandata)
+                self.overheads.extend(scan.overheads)
+                self.errors.update(scan.errors)
+                self.passes += 1
+                if self.is_stopped or len(measured) < 2:
+                    break
+                if self.roi:
+                    counts = scandata.roi_counts(self.roi)
+                else:
+                    counts = scandata.counts
+                cen_fw = cen_fwhm(scandata.locations, counts)
+                if previous is not None and all(
+                        abs(new - old) <= self.tolerance
+                        for new, old in zip(cen_fw, previous)):
+                    break
+                previous = cen_fw
+                todo = self._refine(measured, counts)
+        finally:
+            self._restore_settings()
+        self.data = scandata
+        self.plotqueue.join()
+
+    def _move_to_index(self, i, phase):
+        return self._move_to(self.locs[i], phase)
+
+    def _refine(self, measured, counts):
+        """Returns indices in `self.locs` splitting the intervals between
+        measured points that need more points."""
+        counts = np.asarray(counts, dtype=float)
+        height = counts.max() - counts.min()
+        if height <= 0:
+            return []
+        half = counts.min() + height/2.
+        peak = np.argmax(counts)
+        todo = []
+        for n in range(len(measured) - 1):
+            first, last = measured[n], measured[n + 1]
+            if last - first < 2:
+                continue
+            below, above = counts[n] - half, counts[n + 1] - half
+            if (below*above <= 0 or n in (peak - 1, peak) or
+                    abs(above - below) > self.max_change*height):
+                todo.append((first + last)//2)
+        return todo
+
+
+class FlyScanThread(ScanThread):
+    """Thread for acquiring linear scan data while the motor moves.
+
+    The motor crosses the scan range at the constant speed of one step per
+    `acctime`, starting and ending one step outside the range so that it
+    is at speed throughout.  The MCA counts without stopping and the
+    spectrum is read every `acctime` seconds.  Each spectrum of the scan
+    holds the counts between two readouts, and is located at the motor's
+    tracked position halfway between them.
+
+    Attributes:
+        motor: Motor to scan
+        locs: Evenly spaced locations of the centers of the scan bins
+        num_chans: Number of MCA channels to use, or None to leave unchanged.
+
+    Raises:
+        ValueError: Fewer than two locations, or no spacing between them.
+    """
+    def __init__(self, det, motor, acctime, locs, num_chans=None):
+        if len(locs) < 2 or locs[1] == locs[0]:
+            raise ValueError('A fly scan needs at least two distinct, evenly '
+                             'spaced locations')
+        super(FlyScanThread, self).__init__(det, acctime)
+        self.motor = motor
+        self.locs = locs
+        self.num_chans = num_chans
+        self.name = "FlyScanThread"
+
+    def run(self):
+        step = self.locs[1] - self.locs[0]
+        first = self.locs[0] - step/2.
+        last = self.locs[-1] + step/2.
+        scandata = LinearScan([], [], self.motor.name, time.asctime())
+        self.data = scandata
+        try:
+            self._use_profile([self.motor], 'traverse')
+            self.move = self.motor.start_move(self._clamp(first - step))
+            self.move.join()
+            if not (self.is_stopped or self.move.errors):
+                self._fly(scandata, step, first, last)
+        finally:
+            self.det.disable_mca()
+            if self.move is not None:
+                self.move.stop()
+                self.move.join()
+            self._restore_settings()
+        if self.move is not None:
+            self.errors = {motor.name: error
+                           for motor, error in self.move.errors.items()}
+        self.plotqueue.join()
+
+    def _fly(self, scandata, step, first, last):
+        """Moves through the scan range at constant speed, binning spectra
+        read every `acctime` into `scandata`."""
+        settings = self.det.get_all_settings()
+        end = self._clamp(last + step)
+        duration = abs(end - self.motor.pos)/abs(step)*self.acctime
+        speed = self.motor.speed2data(abs(step)/self.acctime)
+        self._change_settings(self.motor, {com.SPEED: speed})
+        self.det.begin_acq(2*duration + self.acctime, self.num_chans)
+        energies = self.det.get_energies()
+        self.move = self.motor.start_move(end)
+        prev = None
+        next_read = time.time()
+        while True:
+            readtime = time.time()
+            counts, status = self.det.get_spectrum()
+            if prev is not None:
+                self._add_bin(scandata, prev, (readtime, counts, status),
+                              energies, settings, (first, last))
+            prev = (readtime, counts, status)
+            if self.move.done() or self.is_stopped:
+                break
+            next_read += self.acctime
+            self._stopper.wait(max(next_read - time.time(), 0))
+
+    def _clamp(self, position):
+        """Returns the position in the motor's range nearest `position`."""
+        c = self.motor.conversion
+        return min(max(position, c.min_pos), c.max_pos)
+
+    def _add_bin(self, scandata, prev, current, energies, settings, extent):
+        """Appends the counts between two readouts to `scandata` if the motor
+        was within `extent` halfway between them."""
+        midtime = (prev[0] + current[0])/2.
+        loc = self.motor.position_at(midtime)
+        if not min(extent) <= loc <= max(extent):
+            return
+        spectrum = Spectrum(current[1] - prev[1], energies, current[2],
+                            time.asctime(time.localtime(midtime)))
+        spectrum.settings = settings
+        scandata.locations.append(loc)
+        scandata.spectra.append(spectrum)
+        self.plotqueue.put(scandata)
+        self.specqueue.put(spectrum)
+
 
 class GridScanThread(ScanThread):
     """Thread for acquiring grid scan data (motors dx and dy).
@@ -102,37 +515,190 @@ class GridScanThread(ScanThread):
         sio: StageIO object controlling motors
         xlocs: List of locations of motor `dx`
         ylocs: List of locations of motor `dy`
+        num_chans: Number of MCA channels to use, or None to leave unchanged.
+        plan (ScanPlan): The grid, visited in serpentine order
+        overheads: Wall time (seconds) beyond `acctime` spent on each point
     """
-    def __init__(self, det, sio, xlocs, ylocs, acctime):
+    def __init__(self, det, sio, xlocs, ylocs, acctime, num_chans=None):
         super(GridScanThread, self).__init__(det, acctime)
         self.xlocs = xlocs
         self.ylocs = ylocs
-        self.dx = sio.motors['dx']
-        self.dy = sio.motors['dy']
+        self.num_chans = num_chans
+        self.sio = sio
+        self.plan = scan_plans.grid(['dx', 'dy'], [xlocs, ylocs]).reordered(
+            scan_plans.serpentine)
+        self.overheads = []
         self.name = "GridScanThread"
         
     def run(self):
-        spectra = np.empty((len(self.xlocs), len(self.ylocs)), dtype=object)
+        spectra = np.empty(self.plan.shape, dtype=object)
         scandata = GridScan(self.xlocs, self.ylocs, spectra, time.asctime())
-        xlocscopy = list(self.xlocs)
         self.plotqueue.put(scandata)
-        for y in self.ylocs:
-            for x in xlocscopy:
-                if not self.is_stopped:
-                    i, j = self.xlocs.index(x), self.ylocs.index(y)
-                    y_thread = self.dy.start_move(y)
-                    x_thread = self.dx.start_move(x)
-                    y_thread.join()
-                    x_thread.join()
-                    get_settings = not bool(i+j)
-                    specthread = SpectrumAcqThread(self.det, self.acctime,
-                                                   self.specqueue, get_settings)
-                    specthread.start()
-                    specthread.join()
-                    spectrum = specthread.data
-                    scandata.spectra[i, j] = spectrum
-                    spectrum.settings = scandata.spectra[0,0].settings
+        scan = StepScan(self.det, self.acctime, self.specqueue,
+                        self.num_chans, settle_tolerance=self.settle_tolerance)
+        try:
+            for k, spectrum in scan.run(list(self.plan.order), self._move_to,
+                                        self._stopper):
+                scandata.spectra[self.plan.index(k)] = spectrum
+                self.plotqueue.put(scandata)
+        finally:
+            self._restore_settings()
+        self.overheads = scan.overheads
+        self.errors = scan.errors
+        self.data = scandata
+        self.plotqueue.join()
+
+    def _move_to(self, k, phase):
+        self._use_profile([self.sio.motors[axis] for axis in self.plan.axes],
+                          phase)
+        self.move = self.sio.move(self.plan.targets(k))
+        return self.move
+
+
+class AdaptiveGridScanThread(GridScanThread):
+    """Thread for grid scans that refine only where the beam is.
+
+    The grid is first covered by cells of `coarse_size` points on a side,
+    each measured at its centre.  After each pass, every cell whose counts
+    are above `threshold`, or differ from a neighbouring cell by more than
+    `max_change`, is split into four, until cells are single points.  Both
+    are fractions of the range of counts measured so far.  The points of
+    each pass are visited in nearest-neighbour order.
+
+    Attributes:
+        roi: Region of interest whose counts guide refinement, or None to
+            use total counts
+        coarse_size: Side of the initial cells in grid points
+        threshold: Fraction of the range of counts above the minimum beyond
+            which cells are split
+        max_change: Fraction of the range of counts by which neighbouring
+            cells may differ before they are split
+        passes: Number of passes made
+    """
+    def __init__(self, det, sio, xlocs, ylocs, acctime, num_chans=None,
+                 roi=None, coarse_size=4, threshold=0.1, max_change=0.25):
+        super(AdaptiveGridScanThread, self).__init__(det, sio, xlocs, ylocs,
+                                                     acctime, num_chans)
+        self.roi = roi
+        self.coarse_size = coarse_size
+        self.threshold = threshold
+        self.max_change = max_change
+        self.passes = 0
+        self.name = "AdaptiveGridScanThread"
+
+    def run(self):
+        scandata = SparseGridScan(self.xlocs, self.ylocs, time.asctime())
+        nx, ny = len(self.xlocs), len(self.ylocs)
+        size = self.coarse_size
+        leaves = [(i, min(i + size, nx), j, min(j + size, ny))
+                  for j in range(0, ny, size) for i in range(0, nx, size)]
+        scandata.cells.extend(leaves)
+        self.plotqueue.put(scandata)
+        motors = [self.sio.motors['dx'], self.sio.motors['dy']]
+        self.overheads = []
+        self.passes = 0
+        try:
+            # paths are ordered by the speeds of moves between points
+            self._use_profile(motors, 'step')
+            speeds = [motor.speed for motor in motors]
+            while leaves and not self.is_stopped:
+                indices = sorted(set(SparseGridScan.center(cell)
+                                     for cell in leaves) -
+                                 set(scandata.spectra))
+                points = [(self.xlocs[i], self.ylocs[j]) for i, j in indices]
+                plan = scan_plans.point_set(['dx', 'dy'], points)
+                self.plan = plan.reordered(scan_plans.nearest_neighbour,
+                                           speeds,
+                                           [motor.pos for motor in motors])
+                scan = StepScan(self.det, self.acctime, self.specqueue,
+                                self.num_chans,
+                                settle_tolerance=self.settle_tolerance)
+                for k, spectrum in scan.run(list(self.plan.order),
+                                            self._move_to, self._stopper):
+                    scandata.spectra[indices[k]] = spectrum
                     self.plotqueue.put(scandata)
-            xlocscopy.reverse()
+                self.overheads.extend(scan.overheads)
+                self.errors.update(scan.errors)
+                self.passes += 1
+                if self.is_stopped:
+                    break
+                leaves = self._split(scandata, leaves)
+                scandata.cells.extend(leaves)
+        finally:
+            self._restore_settings()
+        self.data = scandata
+        self.plotqueue.join()
+
+    def _split(self, scandata, leaves):
+        """Returns the cells that `leaves` needing refinement split into."""
+        if self.roi:
+            counts = scandata.roi_counts(self.roi)
+        else:
+            counts = scandata.counts
+        measured = counts[counts >= 0]
+        if not len(measured):
+            return []
+        low = measured.min()
+        height = measured.max() - low
+        if height <= 0:
+            return []
+        children = []
+        for cell in leaves:
+            i0, i1, j0, j1 = cell
+            if i1 - i0 < 2 and j1 - j0 < 2:
+                continue
+            value = counts[SparseGridScan.center(cell)]
+            around = counts[max(i0 - 1, 0):i1 + 1, max(j0 - 1, 0):j1 + 1]
+            around = around[around >= 0]
+            if (value - low > self.threshold*height or
+                    np.abs(around - value).max() > self.max_change*height):
+                imid = (i0 + i1 + 1)//2
+                jmid = (j0 + j1 + 1)//2
+                for ia, ib in ((i0, imid), (imid, i1)):
+                    for ja, jb in ((j0, jmid), (jmid, j1)):
+                        if ia < ib and ja < jb:
+                            children.append((ia, ib, ja, jb))
+        return children
+
+
+class PlanScanThread(ScanThread):
+    """Thread for acquiring data at the points of any ScanPlan.
+
+    Attributes:
+        sio: StageIO object controlling motors
+        plan (ScanPlan): Points to measure, in the order to visit them
+        num_chans: Number of MCA channels to use, or None to leave unchanged.
+        overheads: Wall time (seconds) beyond `acctime` spent on each point
+    """
+    def __init__(self, det, sio, plan, acctime, num_chans=None):
+        super(PlanScanThread, self).__init__(det, acctime)
+        self.sio = sio
+        self.plan = plan
+        self.num_chans = num_chans
+        self.overheads = []
+        self.name = "PlanScanThread"
+
+    def run(self):
+        spectra = [None]*len(self.plan)
+        scandata = PointScan(self.plan.axes, self.plan.points, spectra,
+                             time.asctime())
+        scan = StepScan(self.det, self.acctime, self.specqueue,
+                        self.num_chans, settle_tolerance=self.settle_tolerance)
+        try:
+            for k, spectrum in scan.run(list(self.plan.order), self._move_to,
+                                        self._stopper):
+                scandata.spectra[k] = spectrum
+                self.plotqueue.put(scandata)
+        finally:
+            self._restore_settings()
+        self.overheads = scan.overheads
+        self.errors = scan.errors
         self.data = scandata
         self.plotqueue.join()
+
+    def _move_to(self, k, phase):
+        self._use_profile([self.sio.motors[axis] for axis in self.plan.axes],
+                          phase)
+        self.move = self.sio.move(self.plan.targets(k))
+        return self.move
+
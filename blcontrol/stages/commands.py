@@ -4,6 +4,7 @@ See http://www.zaber.com/wiki/Manuals/Binary_Protocol_Manual for a complete list
 of available commands.
 """
 
+RESET =      0
 HOME =       1
 RENUMBER =   2
 MTRACK =     8  # move tracking
@@ -11,15 +12,19 @@ MANMTRACK = 10  # manual move tracking
 MANMV =     11  # manual move displacement
 MVABS =     20  # move absolute
 STOP =      23  
+RESTORE =   36  # restore settings to defaults
 MICRORES =  37  # microstep resolution
 RUNCURR =   38
 HOLDCURR =  39
 MODE =      40  
+SPEED =     42  # target speed
+ACCEL =     43  # acceleration
 GET =       53  # get value of setting in data field
 STATUS =    54
 ECHO =      55
 POS =       60  # get current position
 SERNUM =    63  # serial number
+MSGIDMODE = 102  # message ID mode
 ERROR =    255
 
 #Dictionary mapping error codes from the device to error strings.
@@ -0,0 +1,393 @@
+"""This module emulates a daisy chain of Zaber stages on a pseudo-terminal.
+
+`ZaberEmulator` serves the Zaber binary protocol on the slave end of a pty, so
+that `stageio.StageIO` can be run unmodified, e.g. for benchmarks, with no
+stages attached:
+
+    emu = ZaberEmulator(config)
+    emu.start()
+    sio = StageIO(emu.config(), ZeroPosConfig(tmpfile))
+    ...
+    emu.stop()
+
+One axis is emulated for each serial number in the [Motor Names] section of
+the configuration.  Each axis moves with a trapezoidal velocity profile set by
+its target speed and acceleration, sends move tracking messages while moving
+if enabled in its device mode, and replies with errors for invalid commands
+and out-of-range moves.  Message ID mode is supported.  Every 6-byte frame
+takes its transmission time at the emulated baud rate in each direction, and
+replies from all axes share the line.
+"""
+
+import collections
+import ConfigParser
+import os
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+
+import stages.commands as com
+
+FRAME_LEN = 6
+
+## Command numbers emulated in addition to those in `stages.commands`
+RESET = 0
+SET_SPEED = 42
+SET_ACCEL = 43
+SET_MAXPOS = 44
+SET_POS = 45
+DEVICE_ID = 50
+TRACKING_PERIOD = 117
+
+## Factory defaults (Zaber Binary Protocol Manual)
+DEFAULT_MICRORES = 64
+DEFAULT_SPEED = 20972       # data units, 1 rev/s of a 200 step motor
+DEFAULT_ACCEL = 11          # data units, 67139 microsteps/s^2
+DEFAULT_TRACKING_PERIOD = 250   # ms
+DEFAULT_MODE = 1 << 11      # reserved bit set on A-series devices
+DEFAULT_MAXPOS = 1 << 22    # microsteps, for rotary stages
+DEVICE_ID_CODE = 30211
+
+## Speed and acceleration data units (Cmd 42, Cmd 43)
+SPEED_UNIT = 1/1.6384           # microsteps/s per data unit
+ACCEL_UNIT = 10000/1.6384       # microsteps/s^2 per data unit
+
+MOVE_TRACKING_BIT = 1 << 4
+MESSAGE_ID_BIT = 1 << 6
+HOME_STATUS_BIT = 1 << 7
+
+## Settings that may be written with a command and read with GET
+SETTINGS = (com.MICRORES, com.RUNCURR, com.HOLDCURR, com.MODE, SET_SPEED,
+            SET_ACCEL, SET_MAXPOS, TRACKING_PERIOD)
+
+
+class EmulatedAxis(object):
+    """The state of a single emulated Zaber device.
+
+    Attributes:
+        number (int): Device number assigned by renumbering.
+        sernum (int): Serial number.
+        settings (dict): Maps setting command numbers to their values.
+        pos (float): Current position in microsteps.
+        velocity (float): Current velocity in microsteps/s.
+        target (float): Target position of the current move, or None when
+            the axis is decelerating to a stop.
+        command (int): Command number of the move in progress, or None when
+            idle.
+        move_id (int): Message ID of the command the move in progress will
+            reply to.
+    """
+    def __init__(self, number, sernum, maxpos=DEFAULT_MAXPOS):
+        self.number = number
+        self.sernum = sernum
+        self.settings = {
+            com.MICRORES: DEFAULT_MICRORES,
+            com.RUNCURR: 10,
+            com.HOLDCURR: 20,
+            com.MODE: DEFAULT_MODE,
+            SET_SPEED: DEFAULT_SPEED,
+            SET_ACCEL: DEFAULT_ACCEL,
+            SET_MAXPOS: maxpos,
+            TRACKING_PERIOD: DEFAULT_TRACKING_PERIOD,
+            }
+        self.pos = 0.
+        self.velocity = 0.
+        self.target = None
+        self.command = None
+        self.move_id = 0
+        self.last_track = 0.
+
+    @property
+    def message_ids(self):
+        """True if message IDs are enabled (Cmd 102 or device mode bit 6)."""
+        return bool(self.settings[com.MODE] & MESSAGE_ID_BIT)
+
+    @property
+    def status(self):
+        """Returns the status code returned by Return Status (Cmd 54)."""
+        if self.command is None:
+            return 0
+        if self.target is None:
+            return com.STOP
+        return self.command
+
+    def start_move(self, command, target, now, message_id=0):
+        """Starts or preempts a move to `target`."""
+        self.command = command
+        self.target = float(target)
+        self.move_id = message_id
+        self.last_track = now
+
+    def stop(self, now, message_id=0):
+        """Decelerates to a stop; stops at once if already stopping."""
+        if self.command is not None and self.target is None:
+            self.velocity = 0.
+        self.command = com.STOP
+        self.target = None
+        self.move_id = message_id
+        self.last_track = now
+
+    def advance(self, dt):
+        """Advances the motion by `dt` seconds.
+
+        Returns (bool): True if the move finished.
+        """
+        if self.command is None:
+            return False
+        vmax = self.settings[SET_SPEED]*SPEED_UNIT
+        accel = self.settings[SET_ACCEL]*ACCEL_UNIT
+        if self.target is None:
+            desired = 0.
+        else:
+            distance = self.target - self.pos
+            # fastest speed from which the axis can still stop at the target
+            desired = min(vmax, (2*accel*abs(distance))**0.5)
+            desired = desired if distance >= 0 else -desired
+        change = max(-accel*dt, min(accel*dt, desired - self.velocity))
+        velocity = self.velocity + change
+        self.pos += 0.5*(self.velocity + velocity)*dt
+        self.velocity = velocity
+        if self.target is None:
+            return self.velocity == 0
+        remaining = self.target - self.pos
+        crossed = (remaining > 0) != (distance > 0)
+        if abs(remaining) < 0.5 or crossed and abs(velocity) <= 2*accel*dt:
+            self.pos = self.target
+            self.velocity = 0.
+            return True
+        return False
+
+
+class ZaberEmulator(threading.Thread):
+    """An emulated daisy chain of Zaber devices served on a pseudo-terminal.
+
+    Attributes:
+        port (str): Path of the pty to open as the stages' serial port.
+        axes (list): EmulatedAxis objects, in daisy-chain order.
+        baudrate (int): Emulated baud rate; each frame takes 60/baudrate s.
+        latency (float): Time in seconds from receiving a command to sending
+            the reply.
+        renumber_time (float): Time in seconds the devices take to renumber.
+        tick (float): Motion simulation time step in seconds.
+        requests (dict): Number of commands received, by command number.
+    """
+    def __init__(self, config, baudrate=9600, latency=0.001,
+                 renumber_time=0.5, tick=0.002):
+        super(ZaberEmulator, self).__init__()
+        self.daemon = True
+        self._config = config
+        self.baudrate = baudrate
+        self.latency = latency
+        self.renumber_time = renumber_time
+        self.tick = tick
+        self.requests = {}
+        self.axes = []
+        for i, (sernum, name) in enumerate(config.items('Motor Names')):
+            self.axes.append(EmulatedAxis(i + 1, int(sernum),
+                                          self._maxpos(name)))
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave, termios.TCSANOW)
+        self.port = os.ttyname(self._slave)
+        self._stopper = threading.Event()
+        self._inbox = collections.deque()    # (time received, frame)
+        self._outbox = collections.deque()   # (time sent, frame)
+        self._line_free = 0.   # time the outgoing line becomes free
+
+    def config(self):
+        """Returns a copy of the configuration for connecting to the emulator.
+        """
+        config = ConfigParser.SafeConfigParser()
+        for section in self._config.sections():
+            config.add_section(section)
+            for option, value in self._config.items(section):
+                config.set(section, option, value)
+        config.set('Stage Port', 'usbsn', 'EMULATED')
+        config.set('Stage Port', 'serialport', self.port)
+        config.set('Stage Port', 'baudrate', str(self.baudrate))
+        return config
+
+    def _maxpos(self, name):
+        """Returns the range in microsteps of the stage called `name`."""
+        travel = self._config.get('Travel', name)
+        if not travel:
+            return DEFAULT_MAXPOS
+        stepres = self._config.getfloat('Motor Res', name)
+        return int(float(travel)/stepres*DEFAULT_MICRORES)
+
+    @property
+    def frame_time(self):
+        """Time in seconds to transmit one frame at the emulated baud rate."""
+        return 10.*FRAME_LEN/self.baudrate
+
+    def run(self):
+        buf = ''
+        last = time.time()
+        while not self._stopper.is_set():
+            timeout = self.tick
+            if self._outbox:
+                timeout = min(timeout, max(self._outbox[0][0] - time.time(),
+                                           0))
+            ready = select.select([self._master], [], [], timeout)[0]
+            now = time.time()
+            if ready:
+                try:
+                    buf += os.read(self._master, 4096)
+                except OSError:
+                    break
+                # each frame reaches the devices after its transmission time
+                arrival = now
+                while len(buf) >= FRAME_LEN:
+                    arrival += self.frame_time
+                    self._inbox.append((arrival, buf[:FRAME_LEN]))
+                    buf = buf[FRAME_LEN:]
+            while self._inbox and self._inbox[0][0] <= now:
+                self._execute(self._inbox.popleft()[1], now)
+            self._advance(now - last, now)
+            last = now
+            while self._outbox and self._outbox[0][0] <= time.time():
+                os.write(self._master, self._outbox.popleft()[1])
+
+    def stop(self):
+        """Stops serving and closes the pty."""
+        self._stopper.set()
+        if self.is_alive():
+            self.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _reply(self, axis, command, data, message_id=0, delay=0.):
+        """Queues a reply frame from `axis` on the shared line.
+
+        With message IDs enabled the last byte of the frame is `message_id`
+        and only the low 24 bits of `data` are sent.
+        """
+        start = max(time.time() + self.latency + delay, self._line_free)
+        self._line_free = start + self.frame_time
+        frame = struct.pack('<BBi', axis.number, command, int(round(data)))
+        if axis.message_ids:
+            frame = frame[:5] + chr(message_id)
+        self._outbox.append((self._line_free, frame))
+
+    def _advance(self, dt, now):
+        """Advances all axes and sends tracking and completion replies."""
+        for axis in self.axes:
+            command = axis.command
+            if axis.advance(dt):
+                axis.command = None
+                if command == com.HOME:
+                    axis.pos = 0.
+                    axis.settings[com.MODE] |= HOME_STATUS_BIT
+                self._reply(axis, command, axis.pos, axis.move_id)
+            elif (axis.command is not None and
+                  axis.settings[com.MODE] & MOVE_TRACKING_BIT and
+                  now - axis.last_track >=
+                  axis.settings[TRACKING_PERIOD]/1000.):
+                axis.last_track = now
+                self._reply(axis, com.MTRACK, axis.pos)
+
+    def _execute(self, frame, now):
+        device, command, data = struct.unpack('<BBi', frame)
+        # 24-bit data and the message ID, for axes with message IDs enabled
+        short_data = data & 0xFFFFFF
+        if short_data & 0x800000:
+            short_data -= 1 << 24
+        message_id = ord(frame[5])
+        self.requests[command] = self.requests.get(command, 0) + 1
+        for i, axis in enumerate(self.axes):
+            if device not in (0, axis.number):
+                continue
+            if axis.message_ids:
+                axis_data, axis_id = short_data, message_id
+            else:
+                axis_data, axis_id = data, 0
+            if command == com.RENUMBER and device == 0:
+                axis_data = i + 1   # numbered in daisy-chain order
+            self._execute_axis(axis, command, axis_data, axis_id, now)
+
+    def _execute_axis(self, axis, command, data, message_id, now):
+        """Executes a command on one axis and queues any immediate reply."""
+        if command in (com.MVABS, com.HOME):
+            if command == com.HOME:
+                # the home sensor is at position 0
+                data = 0
+                axis.settings[com.MODE] &= ~HOME_STATUS_BIT
+            elif not 0 <= data <= axis.settings[SET_MAXPOS]:
+                self._reply(axis, com.ERROR, command, message_id)
+                return
+            axis.start_move(command, data, now, message_id)
+        elif command == com.STOP:
+            if axis.command is None:
+                self._reply(axis, com.STOP, axis.pos, message_id)
+            else:
+                axis.stop(now, message_id)
+        elif command == RESET:
+            axis.stop(now)
+            axis.velocity = 0.
+            axis.command = None
+            axis.settings[com.MODE] &= ~HOME_STATUS_BIT
+        elif command == com.RENUMBER:
+            axis.number = data
+            self._reply(axis, command, data, message_id,
+                        delay=self.renumber_time)
+        elif command == com.POS:
+            self._reply(axis, command, axis.pos, message_id)
+        elif command == com.SERNUM:
+            self._reply(axis, command, axis.sernum, message_id)
+        elif command == com.STATUS:
+            self._reply(axis, command, axis.status, message_id)
+        elif command == com.ECHO:
+            self._reply(axis, command, data, message_id)
+        elif command == DEVICE_ID:
+            self._reply(axis, command, DEVICE_ID_CODE, message_id)
+        elif command == com.GET:
+            self._return_setting(axis, data, message_id)
+        elif command == SET_POS:
+            axis.pos = float(data)
+            self._reply(axis, command, data, message_id)
+        elif command == com.MSGIDMODE:
+            if data not in (0, 1):
+                self._reply(axis, com.ERROR, command, message_id)
+                return
+            axis.settings[com.MODE] &= ~MESSAGE_ID_BIT
+            axis.settings[com.MODE] |= data*MESSAGE_ID_BIT
+            self._reply(axis, command, data, message_id)
+        elif command in SETTINGS:
+            if not self._is_valid(axis, command, data):
+                self._reply(axis, com.ERROR, command, message_id)
+                return
+            axis.settings[command] = data
+            self._reply(axis, command, data, message_id)
+        else:
+            self._reply(axis, com.ERROR, 64, message_id)   # command invalid
+
+    def _return_setting(self, axis, setting, message_id):
+        if setting == com.MSGIDMODE:
+            self._reply(axis, setting, axis.message_ids, message_id)
+        elif setting in axis.settings:
+            self._reply(axis, setting, axis.settings[setting], message_id)
+        elif setting in (com.POS, SET_POS):
+            self._reply(axis, setting, axis.pos, message_id)
+        elif setting == com.SERNUM:
+            self._reply(axis, setting, axis.sernum, message_id)
+        elif setting == DEVICE_ID:
+            self._reply(axis, setting, DEVICE_ID_CODE, message_id)
+        else:
+            self._reply(axis, com.ERROR, 53, message_id)   # setting invalid
+
+    def _is_valid(self, axis, command, data):
+        """Returns False if `data` is out of range for a setting."""
+        microres = axis.settings[com.MICRORES]
+        if command == com.MICRORES:
+            return 1 <= data <= 256
+        if command == SET_SPEED:
+            return 1 <= data <= 16384*microres
+        if command == SET_ACCEL:
+            return 0 < data <= 32767
+        if command == SET_MAXPOS:
+            return data > 0
+        if command == TRACKING_PERIOD:
+            return 10 <= data <= 65535
+        return data >= 0
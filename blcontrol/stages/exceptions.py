@@ -0,0 +1,14 @@
+""" This module defines special exceptions raised by the `stageio` module."""
+
+import stages.commands as com
+
+class DeviceError(Exception):
+    """Exception raised when a device replies with an error code."""
+    def __init__(self, reply):
+        super(DeviceError, self).__init__()
+        self.reply = reply
+
+    def __str__(self):
+        return "Device {0} returned error code {1}: {2}".format(
+            self.reply.device_number, self.reply.data,
+            com.ERRORDICT.get(self.reply.data, 'Unknown error'))
@@ -1,18 +1,73 @@
 """This module defines classes for communication with beamline stages."""
 
+import atexit
+import collections
 import ConfigParser
+import numpy as np
 import os
 import Queue
 import serial.tools.list_ports
+import stat
+import tempfile
 import threading
 import time
 import zaber.serial as zb
 
 import stages.commands as com
+from stages.exceptions import DeviceError
+
+FRAME_LEN = 6   # length in bytes of a binary protocol command or reply
+
+## Commands whose reply marks the end of a move
+MOVE_COMMANDS = (com.HOME, com.MVABS, com.STOP)
+
+## Commands whose reply data is the position of the motor
+POSITION_COMMANDS = (com.MTRACK, com.MANMTRACK, com.MANMV, com.POS, com.HOME,
+                     com.MVABS, com.STOP)
+
+## Commands whose reply reports the position of a motor at rest
+REST_COMMANDS = (com.POS, com.HOME, com.MVABS, com.STOP, com.MANMV)
+## Commands after which the controller's settings may have changed
+SETTINGS_RESET_COMMANDS = (com.RESET, com.RENUMBER, com.RESTORE)
+
+## Commands the device never replies to
+NO_REPLY_COMMANDS = (com.RESET,)
+
+## Number of positions kept in each motor's position history
+HISTORY_LEN = 4096
+
+## Range of command data with message IDs enabled, which leaves 24 data bits
+MSGID_DATA_RANGE = (-(1<<23), (1<<23) - 1)
+
+## Seconds to wait for replies from motors missing from the topology cache
+EXTRA_REPLY_WAIT = 0.05
+
+## Microsteps/s per unit of speed data (Cmd 42)
+SPEED_UNIT = 1/1.6384
+
+## Microsteps/s^2 per unit of acceleration data (Cmd 43)
+ACCEL_UNIT = 10000/1.6384
+
+## Prefix of config sections defining motion profiles.  Each maps motor names
+## to a speed in real units/s and an acceleration in real units/s^2.
+PROFILE_PREFIX = 'Profile '
+
+## Seconds after the latest change of a zero position before it is written
+ZERO_WRITE_DELAY = 1.0
+
+## Constants for converting a motor's positions between steps and real units.
+## `min_pos` and `max_pos` are the limits of travel in real units, infinite
+## for rotary stages.
+Conversion = collections.namedtuple('Conversion',
+                                    'resolution zeropos min_pos max_pos')
 
 class StageIO(object):
     """Class for communication with motors.
 
+    The motors are put in message ID mode, so that every command sent with
+    `Motor.send` can be matched to its reply.  Replies to commands sent to
+    all motors carry message ID 0 and go to each motor's `reply_queue`.
+
     Attributes:
         config (ConfigParser): A configuration object with serial port and motor
             configuration information.
@@ -20,17 +75,29 @@ class StageIO(object):
         motors_by_num (dict): Maps motor numbers to Motor objects.
         port (zaber.serial.BinarySerial): Represents the serial port to which
             the motor controllers are connected.
+        pending (PendingReplies): Replies awaited from all motors.
+        executor (MotionExecutor): Starts coordinated moves of the motors.
+        topology (TopologyCache): The motors found on each serial port.
     """
     
-    def __init__(self, config):
+    def __init__(self, config, zeroposconfig=None, topology=None):
         """Inits StageIO using configuration parameters.
 
         Args:
             config (ConfigParser): Contains the serial port information and all
                 necessary motor configuration parameters.
+            zeroposconfig (ZeroPosConfig, optional): Zero positions of the
+                motors.  Defaults to the beamline data file.
+            topology (TopologyCache, optional): The motors found on each
+                serial port.  Defaults to the beamline topology file.
         """
         self.config = config
-        self.zeroposconfig = ZeroPosConfig()
+        if zeroposconfig is None:
+            zeroposconfig = ZeroPosConfig()
+        self.zeroposconfig = zeroposconfig
+        if topology is None:
+            topology = TopologyCache()
+        self.topology = topology
         self.motors = {}
         self.motors_by_num = {}
         self._find_port()
@@ -58,52 +125,167 @@ class StageIO(object):
         self.port._ser.flushInput()
 
     def initialize_motors(self):
-        """Populates `self.motors` with objects for each connected motor."""
+        """Populates `self.motors` with objects for each connected motor.
+
+        If the motors answering on the port are those remembered in
+        `self.topology`, their numbers, serial numbers and resolutions are
+        taken from there.  Otherwise the motors are renumbered and queried,
+        and `self.topology` is updated.
+        """
+        usbsn = self.config.get('Stage Port', 'usbsn')
+        cached = self.topology.get_topology(usbsn)
         old_timeout = self.port.timeout  # Save previous timeout
         try:
-            #Set timeout to 1 second.  The number of motors is
-            #determined by how many replies are read before a timeout occurs.
             self.port.timeout = 1
             self.port._ser.reset_input_buffer()
+            if cached is not None and not self._verify_topology(cached):
+                cached = None
+            if cached is None:
+                motornums = self._discover_motors()
+            else:
+                motornums = sorted(cached)
 
-
-            # need to renumber all motors. motors are identified by their
-            # replies
-            motornums = []
-            self.port.write(0, com.RENUMBER)
-            #time.sleep(0.5)
-            while True:
-                try:
-                    reply = self.port.read()
-                    motornums.append(reply.device_number)
-                except zb.exceptions.TimeoutError:
-                    break
+            self.port.write(0, com.MSGIDMODE, 1)
+            for _ in motornums:
+                self.port.read(message_id=True)
 
             # set up motors and position data queues
+            self.pending = PendingReplies()
             pos_queues = {}
             reply_queues = {}
+            histories = {}
+            settings = {}
             for motor_num in motornums:
                 motor = Motor(motor_num, self.port, self.config,
-                              self.zeroposconfig)
+                              self.zeroposconfig, self.pending)
                 self.motors_by_num[motor_num] = motor
                 pos_queues[motor_num] = motor.pos_queue
                 reply_queues[motor_num] = motor.reply_queue
+                histories[motor_num] = motor.history
+                settings[motor_num] = motor._settings
 
             # start thread to continuously monitor serial port
-            self.reader = SerialPortReader(self.port, pos_queues, reply_queues)
+            self.reader = SerialPortReader(self.port, pos_queues, reply_queues,
+                                           self.pending, histories, settings)
             self.reader.start()
         finally:
             self.port.timeout = old_timeout # Restore previous timeout
 
-        # finish initializing motors by setting serial number and 
+        # finish initializing motors by setting serial number and resolution
         for motor in self.motors_by_num.values():
-            motor.post_init()
+            if cached is None:
+                motor.post_init()
+            else:
+                sernum, _, microstep_res = cached[motor.number]
+                motor.post_init(sernum, microstep_res)
         self.motors = {motor.name : motor for motor in
                         self.motors_by_num.values()}
+        self.executor = MotionExecutor(self.motors)
+        if cached is None:
+            self.topology.set_topology(usbsn, self.motors_by_num.values())
+            self.topology.write_file()
         self.enable_move_tracking()
+
+    def _discover_motors(self):
+        """Renumbers all motors and returns their numbers.
+
+        The number of motors is determined by how many replies are read
+        before the port times out.
+        """
+        # need to renumber all motors. motors are identified by their
+        # replies
+        motornums = []
+        self.port.write(0, com.RENUMBER)
+        while True:
+            try:
+                reply = self.port.read()
+                motornums.append(reply.device_number)
+            except zb.exceptions.TimeoutError:
+                break
+        return motornums
+
+    def _verify_topology(self, cached):
+        """Checks that the motors on the port are those in `cached`.
+
+        All motors are asked for their serial numbers and microstep
+        resolutions at once.  After the expected number of replies, waits
+        `EXTRA_REPLY_WAIT` for any more.
+
+        Args:
+            cached (dict): A topology from `TopologyCache.get_topology`.
+
+        Returns (bool): True if the motors, their numbers, names and
+            microstep resolutions all match `cached`.
+        """
+        expected = []
+        for number, (sernum, name, microstep_res) in cached.items():
+            if (not self.config.has_option('Motor Names', str(sernum)) or
+                    self.config.get('Motor Names', str(sernum)) != name):
+                return False
+            expected.append((com.SERNUM, number, sernum))
+            expected.append((com.MICRORES, number, microstep_res))
+        found = []
+        self.port.write(0, com.SERNUM)
+        self.port.write(0, com.GET, com.MICRORES)
+        try:
+            while len(found) < len(expected):
+                reply = self.port.read()
+                if reply.command_number in (com.SERNUM, com.MICRORES):
+                    found.append((reply.command_number, reply.device_number,
+                                  reply.data))
+            self.port.timeout = EXTRA_REPLY_WAIT
+            while True:
+                reply = self.port.read()
+                if reply.command_number in (com.SERNUM, com.MICRORES):
+                    found.append((reply.command_number, reply.device_number,
+                                  reply.data))
+        except zb.exceptions.TimeoutError:
+            pass
+        finally:
+            self.port.timeout = 1
+        return sorted(found) == sorted(expected)
                 
+    def close(self):
+        """Closes the serial port, which also ends the reader thread, and
+        writes any pending zero positions.
+
+        Message IDs are turned off first, leaving the devices in the mode
+        other software expects.
+        """
+        self.zeroposconfig.flush()
+        self.send_all(com.MSGIDMODE, 0)
+        for motor in self.motors_by_num.values():
+            try:
+                motor.get_reply(com.MSGIDMODE, timeout=True)
+            except zb.exceptions.TimeoutError:
+                pass
+        self.reader.stop()
+        self.port.close()
+        self.reader.join()
+
+    def move(self, targets):
+        """Moves several motors at once; see `MotionExecutor.move`."""
+        return self.executor.move(targets)
+
+    def use_profile(self, name):
+        """Applies a motion profile to all motors that have it.
+
+        Returns (dict): Maps Motor objects to the previous data of the
+            settings that changed; see `restore_settings`.
+        """
+        return {motor: motor.use_profile(name)
+                for motor in self.motors.values()}
+
+    def restore_settings(self, previous):
+        """Restores settings returned by `use_profile`."""
+        for motor, settings in previous.items():
+            motor.apply_settings(settings)
+
     def send_all(self, command_num, data=0):
         """Send a command to all connected motors."""
+        if command_num in SETTINGS_RESET_COMMANDS:
+            for motor in self.motors.values():
+                motor.invalidate_settings()
         self.port.write(0, command_num, data)
 
     def stop_all(self):
@@ -137,34 +319,133 @@ class Motor(object):
             is connected.
         config (ConfigParser): A configuration object containing the name,
             travel, and resolution information for the motor.
-        reply_queue (Queue): Holds replies from the motor controller.
+        reply_queue (Queue): Holds replies from the motor controller that do
+            not answer a command sent with `send`.
         pos_queue (Queue): Holds position information from the controller.
+        history (PositionHistory): Recent positions reported by the
+            controller.
+        pending (PendingReplies): Replies awaited from all motors.
+        reply_stats (dict): Reply latency statistics by command number.
         resolution (float): The motor's resolution in steps/mm or steps/degree.
+        conversion (Conversion): Constants for converting between steps and
+            real units, updated when the resolution or zero position changes.
+        profiles (dict): Maps names of motion profiles to dicts of setting
+            command numbers and data.
+        microstep_res (int): Number of microsteps per step.
         sernum (int): Serial number of the motor.
         name (str): The name of the motor, user-defined in `self.config`.
         travel (float): The stage's total travel in mm, or None for rotary
             stages.
     """
     
-    def __init__(self, number, port, config, zeroposconfig):
+    def __init__(self, number, port, config, zeroposconfig, pending):
         """Initializes the Motor object."""
         self.number = number
         self.port = port
         self.config = config
         self.zeroposconfig = zeroposconfig
+        self.pending = pending
         self.reply_queue = Queue.Queue()
         self.pos_queue = SingleValQueue()
+        self.history = PositionHistory()
+        self._latency = {}   # command number -> [replies, total, max]
+        self._last_move = None   # ReplyFuture of the latest move command
+        self._settings = {}   # setting command number -> data
+
+    def post_init(self, sernum=None, microstep_res=None):
+        """Sets the name and resolution, querying the controller for the
+        serial number and microstep resolution unless given."""
+        self.set_name(sernum)
+        travelstring = self.config.get('Travel', self.name)
+        self._travel = float(travelstring) if travelstring else None
+        self._max_current = self.config.getfloat('Max Current', self.name)
+        self._zeropos = self.zeroposconfig.getzero(self.name)
+        self.set_resolution(microstep_res)
+        self.set_profiles()
 
-    def post_init(self):
-        self.set_name()
-        self.set_resolution()
+    def _update_conversion(self):
+        """Recomputes `self.conversion` from the resolution, zero position
+        and travel."""
+        zp = self._zeropos*self.resolution
+        if self._travel:
+            min_pos, max_pos = -zp, self._travel - zp
+        else:
+            min_pos, max_pos = -np.inf, np.inf
+        self.conversion = Conversion(self.resolution, self._zeropos,
+                                     min_pos, max_pos)
         
     def send(self, commandnum, data=0):
-        """Send a command to the motor controller."""
-        self.port.write(self.number, commandnum, data)
+        """Send a command to the motor controller.
+
+        Any number of commands may be outstanding at once; each is matched to
+        its reply by message ID.  Commands in `NO_REPLY_COMMANDS` are sent
+        without a message ID.
+
+        Raises:
+            ValueError: `data` does not fit in the 24 data bits left by
+                message IDs.
+
+        Returns (ReplyFuture): Resolved with the reply to the command, or
+            None for a command that is not replied to.
+        """
+        if not MSGID_DATA_RANGE[0] <= data <= MSGID_DATA_RANGE[1]:
+            raise ValueError('Command data {0} out of range'.format(data))
+        if commandnum in SETTINGS_RESET_COMMANDS:
+            self.invalidate_settings()
+        if commandnum in NO_REPLY_COMMANDS:
+            self.port.write(self.number, commandnum, data, 0)
+            return None
+        future = self.pending.add(self.number, commandnum)
+        if commandnum in MOVE_COMMANDS:
+            self._last_move = future
+        future.add_done_callback(self._record_latency)
+        self.port.write(self.number, commandnum, data, future.message_id)
+        return future
+
+    def query(self, commandnum, data=0):
+        """Sends a command and waits for its reply.
+
+        Raises:
+            DeviceError: The device replied with an error code.
+            zaber.serial.TimeoutError: No reply within the port's timeout.
+
+        Returns (int): The data of the reply.
+        """
+        future = self.send(commandnum, data)
+        try:
+            return future.result(self.port.timeout).data
+        except zb.exceptions.TimeoutError:
+            self.pending.discard(future)
+            raise
+
+    def _record_latency(self, future):
+        """Records the time between a command and its reply."""
+        reply = future.reply
+        if reply is None or reply.message_id != future.message_id:
+            return   # failed, or a move that was preempted
+        latency = reply.received - future.sent
+        stats = self._latency.setdefault(reply.command_number, [0, 0., 0.])
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+
+    @property
+    def reply_stats(self):
+        """Returns reply latency statistics.
+
+        Returns (dict): Maps command numbers to dicts of 'replies', and
+            'total latency', 'mean latency' and 'max latency' in seconds.
+            The latency of a move command is the duration of the move.
+        """
+        return {commandnum: {'replies': n, 'total latency': total,
+                             'mean latency': total/n, 'max latency': worst}
+                for commandnum, (n, total, worst) in self._latency.items()}
 
     def get_reply(self, commandnum=None, blocking=True, timeout=False):
-        """Read a reply from the motor controller.
+        """Read a reply that does not answer a command sent with `send`.
+
+        Replies to commands sent to all motors, e.g. with `StageIO.send_all`,
+        are read with this method.
 
         Args:
             commandnum (int, optional): If provided, this method will return
@@ -193,121 +474,279 @@ class Motor(object):
             
     def stepdata2pos(self, stepdata):
         """Converts steps to real units based on resolution and zero position."""
-        return round((stepdata - self.zeropos)*self.resolution, 4)
+        c = self.conversion
+        return round((stepdata - c.zeropos)*c.resolution, 4)
 
     def pos2stepdata(self, pos):
         """Converts real units to steps based on resolution and zero position."""
-        return int(pos/self.resolution + self.zeropos)
+        c = self.conversion
+        return int(pos/c.resolution + c.zeropos)
+
+    def stepdata2pos_array(self, stepdata):
+        """Converts an array of steps to real units; see `stepdata2pos`.
+
+        Values halfway between two multiples of 0.0001 are rounded to even.
+        """
+        c = self.conversion
+        return np.round((np.asarray(stepdata) - c.zeropos)*c.resolution, 4)
+
+    def pos2stepdata_array(self, positions):
+        """Converts an array of positions to integer steps; see
+        `pos2stepdata`."""
+        c = self.conversion
+        return (np.asarray(positions)/c.resolution + c.zeropos).astype(int)
 
     def get_tracking_pos(self):
         """Reads latest position from position tracking queue.  Blocks
         until tracking data is received."""
         return self.stepdata2pos(self.pos_queue.get_nowait())
         
+    def position_at(self, timestamps):
+        """Returns the position at given times, interpolated from the position
+        history.
+
+        Times before the first or after the last recorded position give the
+        first or last position, respectively.
+
+        Args:
+            timestamps (float or array): Times as returned by `time.time`.
+
+        Raises:
+            ValueError: No positions have been recorded.
+
+        Returns (float or numpy.ndarray): Positions in real units.
+        """
+        times, stepdata, _ = self.history.snapshot()
+        if not len(times):
+            raise ValueError('No positions recorded for motor {0}'.format(
+                self.name))
+        positions = self.stepdata2pos_array(np.interp(timestamps, times,
+                                                      stepdata))
+        if np.ndim(positions) == 0:
+            return float(positions)
+        return positions
+
     def is_in_range(self, position):
         """Returns True if the given position is in the range of the
         stage's travel, False otherwise.  Always True for rotation stages."""
-        zp = self.zeropos*self.resolution
-        return (not self.travel or ((position + zp >= 0)
-                    and (position + zp <= self.travel)))
+        c = self.conversion
+        return c.min_pos <= position <= c.max_pos
+
+    def are_in_range(self, positions):
+        """Returns (numpy.ndarray): Boolean array, True where the position in
+        the array `positions` is in the range of the stage's travel."""
+        c = self.conversion
+        positions = np.asarray(positions)
+        return (positions >= c.min_pos) & (positions <= c.max_pos)
 
     def start_move(self, position):
-        """Signals the motor to begin moving to `position`."""
-        thread = MoveThread(self, position)
-        thread.start()
-        return thread
+        """Signals the motor to begin moving to `position`.
+
+        Returns (MoveHandle): Completes once the motor has stopped.
+        """
+        stepdata = self.pos2stepdata(position)
+        future = self.send(com.MVABS, stepdata)
+        return MoveHandle({self: future}, {self: stepdata})
 
     def get_status(self):
         """Returns a string summarizing the status of the motor."""
-        self.send(com.STATUS)
-        reply = self.get_reply(com.STATUS)
-        return com.STATUSDICT[reply.data]
+        return com.STATUSDICT[self.query(com.STATUS)]
 
     def zero_here(self):
         """Sets the zero of the motor to its current position."""
-        self.send(com.POS)
-        self.zeropos = self.get_reply(com.POS).data
+        self.zeropos = self.query(com.POS)
        
-    def set_resolution(self):
+    def set_resolution(self, microstep_res=None):
         """Sets `self.resolution` based on info from controller and config."""
-        self.send(com.GET, com.MICRORES)
-        microstep_res = self.get_reply(com.MICRORES).data
+        if microstep_res is None:
+            microstep_res = self.query(com.GET, com.MICRORES)
+        self.microstep_res = microstep_res
         stepres = self.config.getfloat('Motor Res', self.name)
         self.resolution = stepres/microstep_res
+        self._update_conversion()
+
+    def set_profiles(self):
+        """Sets `self.profiles` from the profile sections of the config."""
+        self.profiles = {}
+        for section in self.config.sections():
+            if (section.startswith(PROFILE_PREFIX) and
+                    self.config.has_option(section, self.name)):
+                speed, accel = self.config.get(section, self.name).split()
+                name = section[len(PROFILE_PREFIX):]
+                self.profiles[name] = {
+                    com.SPEED: self.speed2data(float(speed)),
+                    com.ACCEL: self.accel2data(float(accel))}
+
+    def get_setting(self, setting):
+        """Returns the data of a setting, read from the controller only the
+        first time after it was set or the cache was invalidated."""
+        if setting not in self._settings:
+            self._settings[setting] = self.query(com.GET, setting)
+        return self._settings[setting]
+
+    def set_setting(self, setting, data):
+        """Sets a setting, unless it is known to have this value already.
 
-    def set_name(self):
-        self.send(com.SERNUM)
-        sernum = self.get_reply(com.SERNUM).data
+        If the write fails or times out, the cached value is discarded,
+        since the setting may or may not have changed.
+        """
+        if self._settings.get(setting) != data:
+            try:
+                self._settings[setting] = self.query(setting, data)
+            except (DeviceError, zb.exceptions.TimeoutError):
+                self._settings.pop(setting, None)
+                raise
+
+    def invalidate_settings(self):
+        """Discards the cached settings, e.g. after the controller resets,
+        so they are read again when next needed."""
+        self._settings.clear()
+
+    def apply_settings(self, settings):
+        """Sets settings, sending only those that change.
+
+        Args:
+            settings (dict): Maps setting command numbers to data.
+
+        Returns (dict): The previous data of the settings that changed.
+        """
+        previous = {}
+        for setting, data in settings.items():
+            old = self.get_setting(setting)
+            if old != data:
+                previous[setting] = old
+                self.set_setting(setting, data)
+        return previous
+
+    def use_profile(self, name):
+        """Applies a motion profile, sending only the settings that change.
+
+        Args:
+            name (str): Name of the profile.  Nothing is changed if the
+                motor has no such profile, or if `name` is None.
+
+        Returns (dict): The previous data of the settings that changed, to
+            restore with `apply_settings`.
+        """
+        return self.apply_settings(self.profiles.get(name, {}))
+
+    def set_name(self, sernum=None):
+        if sernum is None:
+            sernum = self.query(com.SERNUM)
+        self.sernum = sernum
         self.name = self.config.get('Motor Names', str(sernum))
 
     @property
     def zeropos(self):
-        return self.zeroposconfig.getzero(self.name)
+        return self._zeropos
 
     @zeropos.setter
     def zeropos(self, value):
+        self._zeropos = value
+        self._update_conversion()
         self.zeroposconfig.setzero(self.name, value)
-        self.zeroposconfig.write_file()
 
     @property
     def is_homed(self):
         """Returns True if device has valid home position, False otherwise."""
-        self.send(com.GET, com.MODE)
-        return bool(self.get_reply(com.MODE).data & 1<<7)
+        return bool(self.query(com.GET, com.MODE) & 1<<7)
         
     @property
     def travel(self):
         """Returns device's travel, or None for rotary stages."""
-        travelstring = self.config.get('Travel', self.name)
-        if travelstring:
-            return float(travelstring)
-        else:
-            return None
+        return self._travel
 
     @property
     def pos(self):
-        """Returns device's current position."""
-        self.send(com.POS)
-        stepdata = self.get_reply(com.POS).data
-        return self.stepdata2pos(stepdata)
+        """Returns device's current position; see `get_pos`."""
+        return self.get_pos()
+
+    def get_pos(self, max_age=None):
+        """Returns device's current position.
+
+        The position last reported by the device is used if the device has
+        been at rest since, or if it was reported less than `max_age` seconds
+        ago.  Otherwise the device is queried.
+
+        Args:
+            max_age (float, optional): Age in seconds of the oldest position
+                to accept while the device is moving.
+        """
+        latest = self.history.latest()
+        if latest is not None:
+            received, stepdata, command = latest
+            at_rest = (command in REST_COMMANDS and
+                       (self._last_move is None or self._last_move.done()))
+            if at_rest or (max_age is not None and
+                           time.time() - received <= max_age):
+                return self.stepdata2pos(int(stepdata))
+        return self.stepdata2pos(self.query(com.POS))
 
     @property
     def max_current(self):
-        return self.config.getfloat('Max Current', self.name)
+        return self._max_current
+
+    @property
+    def speed(self):
+        """Gives the speed of moves in real units per second."""
+        return self.get_setting(com.SPEED)*SPEED_UNIT*self.resolution
+
+    @speed.setter
+    def speed(self, value):
+        self.set_setting(com.SPEED, self.speed2data(value))
+
+    @property
+    def accel(self):
+        """Gives the acceleration of moves in real units per second
+        squared."""
+        return self.get_setting(com.ACCEL)*ACCEL_UNIT*self.resolution
+
+    @accel.setter
+    def accel(self, value):
+        self.set_setting(com.ACCEL, self.accel2data(value))
+
+    def speed2data(self, speed):
+        """Converts a speed in real units/s to speed data."""
+        return max(int(round(speed/self.resolution/SPEED_UNIT)), 1)
+
+    def accel2data(self, accel):
+        """Converts an acceleration in real units/s^2 to acceleration data."""
+        return max(int(round(accel/self.resolution/ACCEL_UNIT)), 1)
 
 ## need exceptions to prevent setting currents > max current
 
     @property
     def hold_current(self):
 	"""Gives the holding current of the motor in Amps."""
-        self.send(com.GET, com.HOLDCURR)
-        data = self.get_reply(com.HOLDCURR).data
+        data = self.query(com.GET, com.HOLDCURR)
         return data*0.02 #data is in 20 mA increments
 
     @hold_current.setter
     def hold_current(self, value):
         data = value/0.02
-        self.send(com.HOLDCURR, data)
-	self.get_reply(com.HOLDCURR)
+        self.query(com.HOLDCURR, data)
 
     @property
     def run_current(self):
         """Gives the RMS running current of the motor in Amps"""
-        self.send(com.GET, com.RUNCURR)
-	data = self.get_reply(com.RUNCURR).data
+        data = self.query(com.GET, com.RUNCURR)
         return data*0.014 #data is in increments of 14.1 mA RMS (20 mA peak)
 
     @run_current.setter
     def run_current(self, value):
         data = value/0.014
-        self.send(com.RUNCURR, data)
-        self.get_reply(com.RUNCURR)
+        self.query(com.RUNCURR, data)
         
 
 
 class SerialPortReader(threading.Thread):
     """A thread to monitor the serial port and parse input.
 
+    The thread blocks until a frame arrives and then decodes every complete
+    frame in the input buffer, so replies are dispatched as soon as they are
+    received.  Each reply is stamped with its time of arrival in a
+    `received` attribute.
+
     Attributes:
         port (zaber.serial.BinarySerial): The serial port to read.
         pos_queues (dict): Maps motor numbers to Queues that contain position
@@ -315,63 +754,472 @@ class SerialPortReader(threading.Thread):
         reply_queues (dict): Maps motor numbers to Queues that contain replies
             from that motor (excluding position tracking data).
         error_queue (Queue): Contains error messages received from all motors.
+        pending (PendingReplies): Replies awaited from all motors.
+        histories (dict): Maps motor numbers to PositionHistory objects.
+        settings (dict): Maps motor numbers to the settings caches of the
+            motors, cleared when a motor reports a reset.
     """
     
-    def __init__(self, port, pos_queues, reply_queues):
+    def __init__(self, port, pos_queues, reply_queues, pending, histories,
+                 settings):
         self.port = port
         self.pos_queues = pos_queues
+        self.histories = histories
+        self.settings = settings
         self.reply_queues = reply_queues
+        self.pending = pending
         self.error_queue = Queue.Queue()
+        self._partial = ''   # bytes of an incomplete frame
+        self._stopper = threading.Event()
         super(SerialPortReader, self).__init__()
         self.daemon = True
         self.name = "SerialPortReader"
         
     def _read(self):
-        try:
-            return self.port.read()
-        except zb.TimeoutError:
-            pass
+        """Blocks until a frame is received or the port times out.
+
+        Returns (list): BinaryReply objects for all complete frames received.
+        """
+        ser = self.port._ser
+        nbytes = max(FRAME_LEN - len(self._partial), ser.in_waiting)
+        data = self._partial + ser.read(nbytes)
+        received = time.time()
+        end = len(data) - len(data) % FRAME_LEN
+        self._partial = data[end:]
+        replies = []
+        for i in range(0, end, FRAME_LEN):
+            reply = zb.BinaryReply(data[i:i+FRAME_LEN], message_id=True)
+            reply.received = received
+            replies.append(reply)
+        return replies
 
     def run(self):
         """Continuously reads from `self.port` and sorts inputs into Queues."""
         while True:
-            time.sleep(0.05)
-            reply = self._read()
-            if reply is not None:
-                motor_num = reply.device_number
-                if reply.command_number in (com.MTRACK, com.MANMTRACK,
-                                            com.MANMV, com.POS, com.MVABS,
-                                            com.STOP):
-                    self.pos_queues[motor_num].put(reply.data)
-                if reply.command_number not in (com.MTRACK, com.MANMTRACK,
-                                                com.MANMV, com.ERROR):
-                    self.reply_queues[motor_num].put(reply)
-                if reply.command_number == com.ERROR:
-                    self.error_queue.put(reply)
-
-
-class MoveThread(threading.Thread):
-    """Commands the motor to move and lives until move is complete."""
-    def __init__(self, motor, destination):
-        super(MoveThread, self).__init__()
-        self.daemon = True
-        self.motor = motor
-        self.name = "MoveThread"
-        self.destination = destination
+            try:
+                replies = self._read()
+            except Exception:
+                # reads fail in various ways when the port is closed meanwhile
+                if self._stopper.is_set():
+                    return   # port closed by StageIO.close
+                raise
+            for reply in replies:
+                self._dispatch(reply)
+
+    def stop(self):
+        """Signals the thread to end once the port is closed."""
+        self._stopper.set()
+
+    def _dispatch(self, reply):
+        motor_num = reply.device_number
+        if reply.command_number in POSITION_COMMANDS:
+            self.pos_queues[motor_num].put(reply.data)
+            self.histories[motor_num].append(reply.received, reply.data,
+                                             reply.command_number)
+        if reply.command_number == com.ERROR:
+            self.error_queue.put(reply)
+        if (reply.command_number in SETTINGS_RESET_COMMANDS and
+                motor_num in self.settings):
+            self.settings[motor_num].clear()
+        if (not self.pending.resolve(reply) and
+                reply.command_number not in (com.MTRACK, com.MANMTRACK,
+                                             com.MANMV, com.ERROR)):
+            self.reply_queues[motor_num].put(reply)
+
+
+class MotionExecutor(object):
+    """Starts coordinated moves of several motors.
+
+    All move commands are written back to back, and the moves are tracked
+    through their replies, so no thread is needed per move.
+
+    Attributes:
+        motors (dict): Maps motor names to Motor objects.
+    """
+    def __init__(self, motors):
+        self.motors = motors
+
+    def move(self, targets):
+        """Signals the motors to begin moving to their targets.
+
+        Args:
+            targets (dict): Maps motor names or Motor objects to destinations
+                in real units.
+
+        Returns (MoveHandle): Completes once every motor has stopped.
+        """
+        futures = {}
+        stepdata = {}
+        for axis, position in targets.items():
+            motor = self.motors.get(axis, axis)
+            stepdata[motor] = motor.pos2stepdata(position)
+            futures[motor] = motor.send(com.MVABS, stepdata[motor])
+        return MoveHandle(futures, stepdata)
+
+
+class MoveHandle(object):
+    """Completion handle for moves started together.
+
+    A move is completed when the motor returns either a `move absolute`
+    reply, indicating that it has reached the destination, a `stop` reply,
+    indicating that it was commanded to stop before the destination was
+    reached, or an error, indicating that the move was refused.
+
+    Attributes:
+        futures (dict): Maps Motor objects to the ReplyFuture of their move.
+        targets (dict): Maps Motor objects to their destinations in steps.
+    """
+    def __init__(self, futures, targets):
+        self.futures = futures
+        self.targets = targets
+        self._remaining = len(futures)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if not futures:
+            self._done.set()
+        for future in futures.values():
+            future.add_done_callback(self._move_ended)
+
+    def _move_ended(self, future):
+        with self._lock:
+            self._remaining -= 1
+            if not self._remaining:
+                self._done.set()
+
+    def done(self):
+        """Returns True if all moves are completed."""
+        return self._done.is_set()
+
+    def join(self, timeout=None):
+        """Waits until all moves are completed.
+
+        A refused move counts as completed and does not raise here; check
+        `errors` afterwards, or use `result`, which raises.
+
+        Args:
+            timeout (float, optional): Seconds to wait.  Waits indefinitely
+                if None.
+
+        Raises:
+            zaber.serial.TimeoutError: Moves not completed within `timeout`.
+        """
+        if not self._done.wait(timeout):
+            raise zb.exceptions.TimeoutError('Move timed out.')
+
+    def stop(self):
+        """Signals all motors still moving to stop.
+
+        The moves are completed once the motors have decelerated.
+        """
+        for motor, future in self.futures.items():
+            if not future.done():
+                motor.send(com.STOP)
+
+    @property
+    def errors(self):
+        """Returns (dict): Maps Motor objects to the DeviceError of each move
+        that was refused."""
+        return {motor: future.error for motor, future in self.futures.items()
+                if future.error is not None}
+
+    def result(self, timeout=None):
+        """Waits until all moves are completed and returns final positions.
+
+        Raises:
+            DeviceError: A move was refused.
+            zaber.serial.TimeoutError: Moves not completed within `timeout`.
+
+        Returns (dict): Maps motor names to positions in real units.
+        """
+        self.join(timeout)
+        positions = {}
+        for motor, future in self.futures.items():
+            positions[motor.name] = motor.stepdata2pos(future.result().data)
+        return positions
+
+
+class SettleDetector(object):
+    """Detects the arrival of moving motors from their tracked positions.
+
+    A motor has arrived when its move is completed, or earlier, when two
+    successive tracked positions are both within `tolerance` of its target
+    and differ by no more than `max_motion`, i.e. it has stopped in the
+    tolerance band rather than passing through it.  Tracked positions are
+    reported every move tracking period (Cmd 117), so with a zero tolerance
+    arrival is usually signalled by the move reply.
+
+    Attributes:
+        handle (MoveHandle): The moves to watch.
+        tolerance (float): Distance from the target, in real units, at which
+            a motor that has stopped changing position counts as arrived.
+        max_motion (float): Largest change in real units between successive
+            tracked positions of a motor that has stopped.
+        settle_times (dict): Maps names of motors that have arrived to the
+            time in seconds from sending the move to arrival, or None if
+            the move was refused.
+    """
+    def __init__(self, handle, tolerance=0., max_motion=0.):
+        self.handle = handle
+        self.tolerance = tolerance
+        self.max_motion = max_motion
+        self.settle_times = {}
+        for motor, future in handle.futures.items():
+            future.add_done_callback(lambda _, m=motor: m.history.notify())
+
+    def wait(self, timeout=None):
+        """Waits until all motors have arrived.
+
+        Raises:
+            zaber.serial.TimeoutError: Motors not arrived within `timeout`.
+
+        Returns (dict): `self.settle_times`
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for motor in self.handle.futures:
+            history = motor.history
+            with history.updated:
+                while not self._check(motor):
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise zb.exceptions.TimeoutError(
+                                'Move timed out.')
+                    history.updated.wait(remaining)
+        return self.settle_times
+
+    def _check(self, motor):
+        """Returns True if `motor` has arrived, recording its settle time."""
+        if motor.name in self.settle_times:
+            return True
+        future = self.handle.futures[motor]
+        if future.done() and future.error is not None:
+            self.settle_times[motor.name] = None
+            return True
+        times, stepdata, commands = motor.history.snapshot(since=future.sent)
+        tolerance = self.tolerance/motor.resolution
+        max_motion = self.max_motion/motor.resolution
+        target = self.handle.targets[motor]
+        for i in range(len(times)):
+            if commands[i] in MOVE_COMMANDS:
+                arrived = True
+            else:
+                arrived = (i > 0 and abs(stepdata[i] - target) <= tolerance
+                           and abs(stepdata[i-1] - target) <= tolerance
+                           and abs(stepdata[i] - stepdata[i-1]) <= max_motion)
+            if arrived:
+                self.settle_times[motor.name] = times[i] - future.sent
+                return True
+        if future.done():
+            # preempted or ended before any position was recorded
+            self.settle_times[motor.name] = future.reply.received - future.sent
+            return True
+        return False
+
+
+class ReplyFuture(object):
+    """The awaited reply to a command sent with a message ID.
+
+    Attributes:
+        device_number (int): Number of the motor the command was sent to.
+        command_number (int): Command number sent.
+        message_id (int): Message ID of the command.
+        seq (int): Order in which the command was sent.
+        sent (float): Time the command was sent.
+        reply (zaber.serial.BinaryReply): The reply, once received.  For a
+            move that was preempted, this is the reply that ended the move.
+        error (Exception): Exception to raise from `result`, if any.
+    """
+    def __init__(self, device_number, command_number, message_id, seq):
+        self.device_number = device_number
+        self.command_number = command_number
+        self.message_id = message_id
+        self.seq = seq
+        self.sent = time.time()
+        self.reply = None
+        self.error = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Returns True if the reply has been received."""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the reply and returns it.
+
+        Args:
+            timeout (float, optional): Seconds to wait.  Waits indefinitely
+                if None.
+
+        Raises:
+            DeviceError: The device replied with an error code.
+            zaber.serial.TimeoutError: No reply within `timeout`.
+        """
+        if not self._done.wait(timeout):
+            raise zb.exceptions.TimeoutError('Read timed out.')
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    def add_done_callback(self, func):
+        """Calls `func(self)` once the reply is received, or at once if it
+        already has been."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def set_reply(self, reply, error=None):
+        with self._lock:
+            self.reply = reply
+            self.error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+
+class PendingReplies(object):
+    """Allocates message IDs and matches replies to awaiting commands.
+
+    Message IDs 1-255 are handed out in turn; ID 0 marks replies that do not
+    answer a command with an ID.  A move that is preempted by another move or
+    a stop never replies, so the reply ending a move on a motor also resolves
+    all earlier moves still awaited on that motor.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}   # message ID -> ReplyFuture
+        self._next_id = 1
+        self._seq = 0
+
+    def add(self, device_number, command_number):
+        """Returns a ReplyFuture with a newly allocated message ID."""
+        with self._lock:
+            for _ in range(255):
+                message_id = self._next_id
+                self._next_id = self._next_id % 255 + 1
+                if message_id not in self._futures:
+                    break
+            else:
+                raise RuntimeError('No free message IDs')
+            self._seq += 1
+            future = ReplyFuture(device_number, command_number, message_id,
+                                 self._seq)
+            self._futures[message_id] = future
+        return future
+
+    def discard(self, future):
+        """Stops awaiting the reply to `future`, freeing its message ID.
+
+        A reply arriving later is handled as one that answers no command.
+        """
+        with self._lock:
+            if self._futures.get(future.message_id) is future:
+                del self._futures[future.message_id]
+
+    def resolve(self, reply):
+        """Resolves the futures awaiting `reply`.
+
+        Returns (bool): True if `reply` answered a command with a message ID.
+        """
+        with self._lock:
+            future = self._futures.get(reply.message_id)
+            if (future is not None and
+                    future.device_number != reply.device_number):
+                future = None
+            if future is not None:
+                del self._futures[reply.message_id]
+            ended = []
+            if reply.command_number in MOVE_COMMANDS:
+                for message_id, waiting in self._futures.items():
+                    if (waiting.device_number == reply.device_number and
+                            waiting.command_number in MOVE_COMMANDS and
+                            (future is None or waiting.seq < future.seq)):
+                        ended.append(waiting)
+                        del self._futures[message_id]
+        if future is not None:
+            error = None
+            if reply.command_number == com.ERROR:
+                error = DeviceError(reply)
+            future.set_reply(reply, error)
+        for waiting in ended:
+            waiting.set_reply(reply)
+        return future is not None
+
+
+class PositionHistory(object):
+    """A ring buffer of the latest positions reported by a motor.
+
+    Positions are appended by a single thread, the SerialPortReader.  Other
+    threads read with `snapshot` without locking; entries overwritten while
+    a snapshot is taken are left out of it.
+
+    Attributes:
+        size (int): Number of positions kept.
+        count (int): Number of positions appended since creation.
+        updated (threading.Condition): Notified when a position is appended.
+    """
+    def __init__(self, size=HISTORY_LEN):
+        self.size = size
+        self.count = 0
+        self.updated = threading.Condition()
+        self._times = np.zeros(size)
+        self._stepdata = np.zeros(size, dtype=int)
+        self._commands = np.zeros(size, dtype=np.uint8)
+
+    def append(self, timestamp, stepdata, command_number):
+        """Records a position in steps and the command of the reply that
+        reported it."""
+        i = self.count % self.size
+        self._times[i] = timestamp
+        self._stepdata[i] = stepdata
+        self._commands[i] = command_number
+        self.count += 1
+        self.notify()
+
+    def notify(self):
+        """Wakes threads waiting on `updated`."""
+        with self.updated:
+            self.updated.notify_all()
+
+    def snapshot(self, since=None):
+        """Returns the recorded positions in order of time.
+
+        Args:
+            since (float, optional): Only positions recorded after this time
+                are returned.
+
+        Returns (tuple): Arrays of times, positions in steps and command
+            numbers.
+        """
+        end = self.count
+        times = self._times.copy()
+        stepdata = self._stepdata.copy()
+        commands = self._commands.copy()
+        # the entry being written when the copy ended may be incomplete
+        start = max(0, self.count + 1 - self.size)
+        indices = np.arange(start, end) % self.size
+        times, stepdata, commands = (times[indices], stepdata[indices],
+                                     commands[indices])
+        if since is not None:
+            recent = times > since
+            times, stepdata, commands = (times[recent], stepdata[recent],
+                                         commands[recent])
+        return times, stepdata, commands
+
+    def latest(self):
+        """Returns (tuple): The time, position in steps and command number of
+        the latest entry, or None if there are none."""
+        count = self.count
+        if not count:
+            return None
+        i = (count - 1) % self.size
+        return self._times[i], self._stepdata[i], self._commands[i]
 
-    def run(self):
-        """Sends move command, and reads replies until move is completed.
-
-        Move is completed when the motor returns either a `move absolute`
-        command, indicating that it has reached the destination, or a `stop`
-        command, indicating that it was commanded to stop before the destination
-        was reached."""
-        reply_com = None
-        step_dest = self.motor.pos2stepdata(self.destination)
-        self.motor.send(com.MVABS, step_dest)
-        while reply_com not in (com.MVABS, com.STOP):
-            reply = self.motor.get_reply(timeout=None)
-            reply_com = reply.command_number
 
 class SingleValQueue(Queue.Queue):
     """Implements a queue that holds only a single value."""
@@ -387,15 +1235,28 @@ class SingleValQueue(Queue.Queue):
 
 module_dir = os.path.dirname(__file__)
 cfg_full_path = os.path.join(module_dir, '..','..','config','bldata.txt')
+topology_full_path = os.path.join(module_dir, '..','..','config',
+                                  'topology.txt')
 
 class ZeroPosConfig(ConfigParser.SafeConfigParser):
-    """Implements a config file to hold the zero positions of the motors."""
+    """Implements a config file to hold the zero positions of the motors.
+
+    The zero positions are kept as floats in `zeros`.  Changes are written
+    to the file by a background timer `write_delay` seconds after the latest
+    change, or at exit.
+
+    Attributes:
+        filepath (str): Path of the config file.
+        zeros (dict): Maps motor names to zero positions in microsteps.
+        write_delay (float): Seconds to wait after a change before writing.
+    """
 
     section = "Zero Positions"
 
-    def __init__(self, filepath=cfg_full_path):
+    def __init__(self, filepath=cfg_full_path, write_delay=ZERO_WRITE_DELAY):
         ConfigParser.SafeConfigParser.__init__(self)
         self.filepath = filepath
+        self.write_delay = write_delay
 
         ### open file, or if it doesn't exist, create it, and make sure it
         ### has correct section header
@@ -408,20 +1269,107 @@ class ZeroPosConfig(ConfigParser.SafeConfigParser):
             fp.close()
         if not self.has_section(self.section):
             self.add_section(self.section)
+        self.zeros = {name: float(value)
+                      for name, value in self.items(self.section)}
+        self._lock = threading.Lock()
+        self._timer = None
+        atexit.register(self.flush)
                 
     def getzero(self, name):
-        """Gets the zero position from the config file, or sets it to zero and
-        writes the file if necessary."""
-        if not self.has_option(self.section, name):
-            self.set(self.section, name, '0')
-            self.write_file()
-        return ConfigParser.SafeConfigParser.getfloat(self, self.section, name)
+        """Gets the zero position, or sets it to zero if necessary."""
+        if name not in self.zeros:
+            self.setzero(name, 0)
+        return self.zeros[name]
 
     def setzero(self, name, value):
-        return ConfigParser.SafeConfigParser.set(self, self.section, name,
-                                                 str(value))
+        """Sets the zero position and schedules writing the file."""
+        with self._lock:
+            self.zeros[name] = float(value)
+            ConfigParser.SafeConfigParser.set(self, self.section, name,
+                                              str(value))
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.write_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Writes the file now if a change is pending."""
+        with self._lock:
+            if self._timer is None:
+                return
+            self._timer.cancel()
+            self._timer = None
+            self.write_file()
 
     def write_file(self):
-        with open(self.filepath, 'w') as datafile:
-            self.write(datafile)
-        
+        """Writes the file, never leaving it partly written."""
+        _write_atomically(self, self.filepath)
+
+
+class TopologyCache(ConfigParser.SafeConfigParser):
+    """Implements a config file to remember the motors found on each port.
+
+    Each section is named by the serial number of a USB-to-serial converter
+    and maps motor numbers to the serial number, name and microstep
+    resolution of the motor, separated by spaces.
+    """
+
+    def __init__(self, filepath=topology_full_path):
+        ConfigParser.SafeConfigParser.__init__(self)
+        self.filepath = filepath
+        self.read(self.filepath)
+
+    def get_topology(self, usbsn):
+        """Returns the motors remembered for a port.
+
+        Returns (dict): Maps motor numbers to (serial number, name, microstep
+            resolution) tuples, or None if the port is unknown.
+        """
+        if not self.has_section(usbsn):
+            return None
+        topology = {}
+        for number, entry in self.items(usbsn):
+            sernum, name, microstep_res = entry.split()
+            topology[int(number)] = (int(sernum), name, int(microstep_res))
+        return topology
+
+    def set_topology(self, usbsn, motors):
+        """Remembers `motors`, an iterable of Motor objects, for a port."""
+        if self.has_section(usbsn):
+            self.remove_section(usbsn)
+        self.add_section(usbsn)
+        for motor in motors:
+            self.set(usbsn, str(motor.number), '{0} {1} {2}'.format(
+                motor.sernum, motor.name, motor.microstep_res))
+
+    def write_file(self):
+        """Writes the file, never leaving it partly written."""
+        _write_atomically(self, self.filepath)
+
+
+def _write_atomically(config, filepath):
+    """Writes `config` to a temporary file, then renames it to `filepath`,
+    so the file is never left partly written.
+
+    The file keeps the permissions of the file it replaces, or gets those
+    of a newly created file.  Windows cannot rename onto an existing file,
+    so there the old file is removed first and the replacement is not
+    atomic.
+    """
+    dirname = os.path.dirname(os.path.abspath(filepath))
+    fd, temppath = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        mode = stat.S_IMODE(os.stat(filepath).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0666 & ~umask
+    os.chmod(temppath, mode)
+    with os.fdopen(fd, 'w') as datafile:
+        config.write(datafile)
+        datafile.flush()
+        os.fsync(datafile.fileno())
+    if os.name == 'nt' and os.path.exists(filepath):
+        os.remove(filepath)
+    os.rename(temppath, filepath)
@@ -8,7 +8,7 @@ class FakeDet(object):
         self.mca = False
         self.spectrum = 256*[0]
         
-    def begin_acq(self, acqtime):
+    def begin_acq(self, acqtime, num_chans=None):
         self.mca = True
         self.spectrum = 256*[0]
         timer = threading.Timer(acqtime, self.disable_mca)
@@ -17,7 +17,7 @@ class FakeDet(object):
     def disable_mca(self):
         self.mca = False
     
-    def get_status(self):
+    def get_status(self, *args):
         return {'accumulation time': 30.0,
                 'real time': 33.0,
                 'MCA enabled': self.mca,
@@ -34,7 +34,7 @@ class FakeDet(object):
         return {'PRET':'30.0', 'MCAC':'1024', 'THSL':'8.034', 'THFA':'113',
                 'GAIN':'12.045', 'TPEA':'3.200', 'TECS':'220.0'}
 
-    def get_spectrum(self):
+    def get_spectrum(self, *args):
         new = [i + int(200*np.exp(-1*(i-50)**2) + 100*random.random())
                 for i in self.get_energies()]
         self.spectrum = [self.spectrum[i] + n for i, n in enumerate(new)]
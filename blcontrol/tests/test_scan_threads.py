@@ -0,0 +1,108 @@
+import Queue
+import threading
+import time
+import unittest
+from detector import dp5io, pids
+from detector.emulator import DP5Emulator
+from scan_threads import Exposure, FlyScanThread, StepScan
+from tests.test_stageio import EmulatedStagesTest
+
+class EmulatedDetectorTest(unittest.TestCase):
+    """Base class for tests against an emulated DP5."""
+    def setUp(self):
+        self.emulator = DP5Emulator()
+        self.emulator.start()
+        self.det = dp5io.DP5Device(self.emulator.config())
+
+    def tearDown(self):
+        self.det.disconnect()
+        self.emulator.stop()
+
+
+class ExposureTest(EmulatedDetectorTest):
+    def test_stop_ends_long_exposure_promptly(self):
+        exposure = Exposure(self.det, 30.)
+        exposure.start(256)
+        stopper = threading.Event()
+        threading.Timer(0.2, stopper.set).start()
+        started = time.time()
+        exposure.wait(stopper)
+        self.assertLess(time.time() - started, 1.)
+        self.det.disable_mca()
+
+    def test_end_is_predicted_from_rounded_preset_time(self):
+        # programmed as the minimum preset time of one 0.1 s step
+        exposure = Exposure(self.det, 0.01, poll_interval=0.005)
+        exposure.start(256)
+        polls = self.emulator.requests.get(pids.GETSTAT, 0)
+        exposure.wait()
+        self.assertLessEqual(self.emulator.requests[pids.GETSTAT] - polls, 3)
+
+
+class PresetTimeTest(EmulatedDetectorTest):
+    def test_rounded_preset_time_is_shadowed_as_stored(self):
+        readbacks = self.emulator.requests.get(pids.CONFIG_REQ, 0)
+        self.det.begin_acq(0.26, 256)
+        self.det.disable_mca()
+        self.assertEqual(self.emulator.requests.get(pids.CONFIG_REQ, 0),
+                         readbacks)
+        self.assertEqual(float(self.det.cached_setting('PRET')), 0.3)
+        self.assertEqual(self.det.get_setting('PRET'), '0.3')
+        configs = self.emulator.requests[pids.CONFIG]
+        self.det.begin_acq(0.26, 256)
+        self.det.disable_mca()
+        self.assertEqual(self.emulator.requests[pids.CONFIG], configs)
+
+
+class EmulatedScanTest(EmulatedStagesTest):
+    """Base class for tests against an emulated DP5 and daisy chain."""
+    def setUp(self):
+        super(EmulatedScanTest, self).setUp()
+        self.det_emulator = DP5Emulator()
+        self.det_emulator.start()
+        self.det = dp5io.DP5Device(self.det_emulator.config())
+
+    def tearDown(self):
+        self.det.disconnect()
+        self.det_emulator.stop()
+        super(EmulatedScanTest, self).tearDown()
+
+
+class StepScanTest(EmulatedScanTest):
+    def test_refused_move_ends_scan(self):
+        motor = self.sio.motors['dx']
+        start = motor.pos
+        points = [start, motor.conversion.max_pos + 1., start + 0.05]
+        scan = StepScan(self.det, 0.1, Queue.Queue(), 256)
+        stopper = threading.Event()
+        start_move = lambda point, phase: motor.start_move(point)
+        measured = [point for point, _ in scan.run(points, start_move,
+                                                    stopper)]
+        self.assertEqual(measured, [start])
+        self.assertEqual(list(scan.errors), ['dx'])
+        self.assertTrue(stopper.is_set())
+
+
+class FlyScanStopTest(EmulatedScanTest):
+    def test_stop_during_run_up_ends_scan(self):
+        motor = self.sio.motors['dx']
+        far = motor.conversion.max_pos - 1.
+        thread = FlyScanThread(self.det, motor, 0.1, [far, far + 0.01])
+        thread.start()
+        time.sleep(0.2)
+        thread.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(thread.data.spectra, [])
+        self.assertEqual(thread.errors, {})
+
+
+class FlyScanThreadTest(unittest.TestCase):
+    def test_rejects_scans_without_a_step(self):
+        for locs in ([1.], [1., 1.]):
+            with self.assertRaises(ValueError):
+                FlyScanThread(None, None, 0.1, locs)
+
+
+if __name__ == '__main__':
+    unittest.main()
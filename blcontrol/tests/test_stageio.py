@@ -0,0 +1,129 @@
+import ConfigParser
+import os
+import tempfile
+import unittest
+import zaber.serial as zb
+import stages.commands as com
+from stages.emulator import ZaberEmulator
+from stages.stageio import (Motor, MoveHandle, PendingReplies, SettleDetector,
+                            StageIO, TopologyCache, ZeroPosConfig)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', '..', 'config', 'blconf.txt')
+
+class SilentPort(object):
+    """A serial port whose devices never reply."""
+    def __init__(self, timeout=0.001):
+        self.timeout = timeout
+        self.written = []
+
+    def write(self, *args):
+        self.written.append(args)
+
+
+class PendingRepliesTest(unittest.TestCase):
+    def test_timed_out_queries_free_message_ids(self):
+        port = SilentPort()
+        motor = Motor(1, port, None, None, PendingReplies())
+        for _ in range(300):
+            with self.assertRaises(zb.exceptions.TimeoutError):
+                motor.query(com.POS)
+        future = motor.send(com.POS)
+        self.assertFalse(future.done())
+        self.assertEqual(len(port.written), 301)
+
+
+class MotorSettingsTest(unittest.TestCase):
+    def test_failed_write_discards_cached_setting(self):
+        motor = Motor(1, SilentPort(), None, None, PendingReplies())
+        motor._settings[com.SPEED] = 100
+        with self.assertRaises(zb.exceptions.TimeoutError):
+            motor.set_setting(com.SPEED, 200)
+        self.assertNotIn(com.SPEED, motor._settings)
+
+
+class EmulatedStagesTest(unittest.TestCase):
+    """Base class for tests against an emulated daisy chain."""
+    def setUp(self):
+        self.config = ConfigParser.SafeConfigParser()
+        self.config.read(CONFIG_PATH)
+        self.emulator = ZaberEmulator(self.config)
+        self.emulator.start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.zeropath = os.path.join(self.tmpdir, 'zeros.txt')
+        self.topologypath = os.path.join(self.tmpdir, 'topology.txt')
+        self.sio = self.open_stages()
+
+    def open_stages(self):
+        return StageIO(self.emulator.config(), ZeroPosConfig(self.zeropath),
+                       TopologyCache(self.topologypath))
+
+    def tearDown(self):
+        self.sio.close()
+        self.emulator.stop()
+        for name in os.listdir(self.tmpdir):
+            os.remove(os.path.join(self.tmpdir, name))
+        os.rmdir(self.tmpdir)
+
+
+class SettleDetectorTest(EmulatedStagesTest):
+    def test_passing_through_tolerance_band_is_not_arrival(self):
+        motor = self.sio.motors['dx']
+        start = motor.pos
+        handle = motor.start_move(start + 0.4)
+        # claim the target is half way, so the motor crosses the band
+        # around it at full speed without stopping
+        midway = motor.pos2stepdata(start + 0.2)
+        detector = SettleDetector(MoveHandle(handle.futures,
+                                             {motor: midway}), 0.15)
+        settle_time = detector.wait(10)[motor.name]
+        future = handle.futures[motor]
+        handle.join(10)
+        self.assertAlmostEqual(settle_time,
+                               future.reply.received - future.sent, places=6)
+
+
+class CloseTest(EmulatedStagesTest):
+    def test_close_turns_message_ids_off(self):
+        self.sio.close()
+        self.assertFalse(any(axis.message_ids for axis in self.emulator.axes))
+        self.sio = self.open_stages()
+        self.assertTrue(all(axis.message_ids for axis in self.emulator.axes))
+
+
+class SettingsCacheTest(EmulatedStagesTest):
+    def test_reset_rereads_settings(self):
+        motor = self.sio.motors['dx']
+        speed = motor.get_setting(com.SPEED)
+        axis = [a for a in self.emulator.axes if a.number == motor.number][0]
+        axis.settings[com.SPEED] = speed + 100   # e.g. changed at power-up
+        self.assertEqual(motor.get_setting(com.SPEED), speed)
+        self.assertIsNone(motor.send(com.RESET))
+        self.assertEqual(motor.get_setting(com.SPEED), speed + 100)
+        self.assertFalse(self.sio.pending._futures)
+
+
+class TopologyCacheTest(EmulatedStagesTest):
+    def test_changed_microstep_resolution_is_rediscovered(self):
+        motor = self.sio.motors['dx']
+        self.assertEqual(motor.microstep_res, 64)
+        self.sio.close()
+        axis = [a for a in self.emulator.axes if a.number == motor.number][0]
+        axis.settings[com.MICRORES] = 32
+        self.sio = self.open_stages()
+        self.assertEqual(self.sio.motors['dx'].microstep_res, 32)
+        cached = TopologyCache(self.topologypath).get_topology(
+            self.emulator.config().get('Stage Port', 'usbsn'))
+        self.assertEqual(cached[motor.number][2], 32)
+
+    def test_rewritten_cache_keeps_permissions(self):
+        self.sio.close()
+        os.chmod(self.topologypath, 0640)
+        axis = self.emulator.axes[0]
+        axis.settings[com.MICRORES] = 32
+        self.sio = self.open_stages()
+        self.assertEqual(os.stat(self.topologypath).st_mode & 0777, 0640)
+
+
+if __name__ == '__main__':
+    unittest.main()